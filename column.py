@@ -26,7 +26,7 @@ class Column:
         from {self.tbl.name}
         """
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             return cnxn.execute(text(sql)).fetchval()
 
     def create_index(self, col_type):
@@ -42,7 +42,7 @@ class Column:
             where {self.name} is null
             """
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             cnxn.execute(text(sql))
             cnxn.commit()
 
@@ -56,7 +56,7 @@ class Column:
         where {self.name} is null or {self.name} = ''
         """
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             count = cnxn.execute(text(sql)).first()[0]
 
         rowcount = self.tbl.rowcount
@@ -77,7 +77,7 @@ class Column:
         ) t2
         """
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             max_in_group = cnxn.execute(text(sql)).first()[0]
 
         frequency = max_in_group/self.tbl.rowcount
@@ -2,8 +2,16 @@
 import os
 import time
 import re
+import hashlib
+import itertools
+import threading
+import zlib
+import base64
+from contextlib import contextmanager
 from graphlib import TopologicalSorter
-from sqlalchemy import text, inspect, exc
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, exc
+from sqlalchemy.engine.reflection import ObjectKind
 import sqlglot
 import simplejson as json
 from addict import Dict
@@ -12,16 +20,32 @@ from table import Table
 from grid import Grid
 from user import User
 from datatype import Datatype
+import metadata
+import results
+import lookups
+import search
+
+cfg = Settings()
+# Set in threads running work for Database.map
+worker = threading.local()
+
+
+def set_snapshot(cnxn, snapshot):
+    """Make all reads on connection see the same snapshot of data"""
+    if snapshot and cnxn.engine.name in ['postgresql', 'mysql', 'mariadb']:
+        cnxn.execution_options(isolation_level='REPEATABLE READ')
 
 
 class Database:
     """Contains methods for getting data and metadata from database"""
 
-    def __init__(self, engine, db_name, uid):
+    def __init__(self, engine, db_name, session, cnxn=None):
         self.engine = engine
         self.identifier = db_name
-        self.refl = inspect(engine)
-        self.user = User(engine, name=uid)
+        # Connection shared by all queries within a request
+        self.cnxn = cnxn
+        self.session = session
+        self.user = User(engine, name=session.uid, session=session)
         path = db_name.split('.')
         if engine.name == 'postgresql':
             self.schema = 'public' if len(path) == 1 else path[1]
@@ -36,6 +60,17 @@ class Database:
             self.schema = db_name
             self.cat = None
 
+        # Reflected metadata shared with other requests. Renewed if
+        # the schema has changed since it was reflected
+        self.metadata = metadata.store.get(engine, self.schema)
+        self.fingerprint = self.get_fingerprint()
+        if not self.metadata.check(self.fingerprint):
+            self.metadata = metadata.store.renew(engine, self.schema)
+            self.invalidate_results()
+            self.fingerprint = self.get_fingerprint()
+            self.metadata.check(self.fingerprint)
+        self.refl = self.metadata.refl
+
         if 'urdr' in self.refl.get_schema_names() or db_name == 'urdr.db':
             schema = 'main' if db_name == 'urdr.db' else 'urdr'
             self.cte_access = f"""
@@ -53,13 +88,239 @@ class Database:
         else:
             self.cte_access = None
 
-        self.html_attrs = self.init_html_attributes()
-        attrs = Dict(self.html_attrs.pop('base', None))
-        self.cache = attrs.pop('data-cache', None)
+        html_attrs = self.metadata.fetch(
+            'html_attrs', lambda: Dict(self.init_html_attributes()))
+        self.html_attrs = Dict({selector: attrs for selector, attrs
+                                in html_attrs.items() if selector != 'base'})
+        attrs = html_attrs.get('base', None) or Dict()
+        self.cache = attrs.get('data-cache', None)
+        if (
+            self.cache and self.cache.fingerprint and
+            self.cache.fingerprint != self.fingerprint.catalog
+        ):
+            # Schema is changed after cache was made, so we
+            # reflect the database until cache is updated
+            self.cache = None
         if attrs.get('cache.config', None):
             self.config = self.cache.config
         else:
-            self.config = Dict(Settings())
+            self.config = Dict(cfg)
+
+    def get_fingerprint(self):
+        """Return values that change when the schema is changed
+
+        The catalog fingerprint is read from the database catalog. The
+        attributes fingerprint changes when html_attributes is updated.
+        """
+        params = {'schema': self.schema}
+        if self.engine.name == 'sqlite':
+            catalog = "select schema_version from pragma_schema_version"
+        elif self.engine.name == 'duckdb':
+            catalog = """
+            select count(*) || '.' || sum(table_oid) || '.' ||
+                   sum(column_count) || '.' || sum(index_count) || '.' ||
+                   (select count(*) || '.' || coalesce(sum(view_oid), 0)
+                    from duckdb_views() where schema_name = :schema) || '.' ||
+                   (select count(*) from duckdb_constraints()
+                    where schema_name = :schema)
+            from duckdb_tables()
+            where schema_name = :schema
+            """
+        elif self.engine.name == 'postgresql':
+            catalog = """
+            select
+            (select count(*) || '.' || sum(c.xmin::text::bigint)
+             from pg_class c
+             join pg_namespace n on n.oid = c.relnamespace
+             where n.nspname = :schema) || '.' ||
+            (select coalesce(sum(a.xmin::text::bigint), 0)
+             from pg_attribute a
+             join pg_class c on c.oid = a.attrelid
+             join pg_namespace n on n.oid = c.relnamespace
+             where n.nspname = :schema) || '.' ||
+            (select count(*) || '.' || coalesce(sum(co.xmin::text::bigint), 0)
+             from pg_constraint co
+             join pg_namespace n on n.oid = co.connamespace
+             where n.nspname = :schema) || '.' ||
+            (select count(*) || '.' || coalesce(sum(d.xmin::text::bigint), 0)
+             from pg_description d
+             join pg_class c on c.oid = d.objoid
+             join pg_namespace n on n.oid = c.relnamespace
+             where n.nspname = :schema)
+            """
+        elif self.engine.name in ['mysql', 'mariadb']:
+            # update_time is not used, as it changes with every insert
+            catalog = """
+            select concat_ws('.', count(*), max(create_time),
+                (select sum(crc32(concat_ws('.', table_name, column_name,
+                                            column_type, is_nullable,
+                                            column_default, column_comment)))
+                 from information_schema.columns
+                 where table_schema = :schema),
+                (select count(*) from information_schema.statistics
+                 where table_schema = :schema),
+                (select count(*) from information_schema.key_column_usage
+                 where table_schema = :schema),
+                (select sum(crc32(table_comment))
+                 from information_schema.tables
+                 where table_schema = :schema))
+            from information_schema.tables
+            where table_schema = :schema
+            """
+        elif self.engine.name == 'oracle':
+            catalog = """
+            select count(*) || '.' ||
+                   to_char(max(last_ddl_time), 'YYYYMMDDHH24MISS')
+            from all_objects
+            where owner = :schema
+            """
+        elif self.engine.name == 'mssql':
+            catalog = """
+            select cast(count(*) as varchar) + '.' +
+                   convert(varchar, max(modify_date), 126)
+            from sys.objects
+            where schema_id = schema_id(:schema)
+            """
+        else:
+            catalog = "select null"
+
+        # html_attributes are cached with the metadata, so their content
+        # is hashed to find any change
+        tbl_names = self.metadata.refl.get_table_names(self.schema)
+        table = f"{self.schema}.html_attributes"
+        if 'html_attributes' not in tbl_names:
+            attrs = "select null"
+        elif self.engine.name in ['postgresql', 'duckdb']:
+            attrs = f"""
+            select md5(string_agg(selector || ':' || attributes, ','
+                                  order by selector))
+            from {table}
+            """
+        elif self.engine.name == 'sqlite':
+            # md5 is registered on connections by the engine registry
+            attrs = f"""
+            select md5(group_concat(selector || ':' || attributes, ','))
+            from (select selector, attributes from {table}
+                  order by selector)
+            """
+        elif self.engine.name in ['mysql', 'mariadb']:
+            attrs = f"""
+            select concat_ws('.', count(*),
+                             sum(crc32(concat_ws(':', selector, attributes))))
+            from {table}
+            """
+        elif self.engine.name == 'mssql':
+            attrs = f"""
+            select cast(count(*) as varchar) + '.' + cast(
+                checksum_agg(binary_checksum(selector, attributes)) as varchar)
+            from {table}
+            """
+        elif self.engine.name == 'oracle':
+            attrs = f"""
+            select count(*) || '.' ||
+                   sum(dbms_lob.getlength(attributes)) || '.' ||
+                   sum(ora_hash(selector || ':' ||
+                                dbms_lob.substr(attributes, 4000, 1)))
+            from {table}
+            """
+        else:
+            attrs = f"""
+            select count(*) || '.' || sum(length(attributes))
+            from {table}
+            """
+
+        sql = f"select ({catalog}) as catalog, ({attrs}) as attrs"
+        if self.engine.name == 'oracle':
+            sql += " from dual"
+
+        with self.connect() as cnxn:
+            row = cnxn.execute(text(sql), params).mappings().first()
+
+        return Dict({
+            'catalog': None if row.catalog is None else str(row.catalog),
+            'attrs': None if row.attrs is None else str(row.attrs)
+        })
+
+    @contextmanager
+    def connection(self, snapshot=False):
+        """Open connection used by all queries within the block
+
+        Parameters:
+        snapshot: If all reads should see the same snapshot of data.
+                  Should not be used when writing.
+        """
+        if self.cnxn is not None:
+            yield self.cnxn
+            return
+
+        with self.engine.connect() as cnxn:
+            set_snapshot(cnxn, snapshot)
+            self.cnxn = cnxn
+            try:
+                yield cnxn
+            finally:
+                self.cnxn = None
+
+    @classmethod
+    @contextmanager
+    def open(cls, engine, db_name, session, snapshot=False):
+        """Return database object with connection used by all queries
+
+        The connection is opened before the object is made, so that the
+        check of the shared metadata uses it too.
+        """
+        with engine.connect() as cnxn:
+            set_snapshot(cnxn, snapshot)
+            yield cls(engine, db_name, session, cnxn)
+
+    @contextmanager
+    def connect(self):
+        """Return shared connection if opened, or else a new connection
+
+        Threads running work from `map` get their own connection, as
+        connections can't be used by several threads at once.
+        """
+        if self.cnxn is not None and not getattr(worker, 'active', False):
+            yield self.cnxn
+        else:
+            with self.engine.connect() as cnxn:
+                yield cnxn
+
+    def map(self, func, items):
+        """Return results of calling func on each item, in same order
+
+        Calls are run in a pool of threads when the data-cache is built
+        and more than one worker is configured, as the work mostly is
+        waiting for the database. Other calls are run sequentially on
+        the connection shared in the request, so that they read from
+        the same snapshot and don't use more connections.
+        """
+        workers = min(cfg.workers, len(items))
+        if (
+            workers <= 1 or not self.config.update_cache or
+            getattr(worker, 'active', False)
+        ):
+            return [func(item) for item in items]
+
+        def run(item):
+            worker.active = True
+            try:
+                return func(item)
+            finally:
+                worker.active = False
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, items))
+
+    def prime_metadata(self):
+        """Load metadata shared by tables before work is run in threads"""
+        self.tablenames
+        self.columns
+        self.pkeys
+        self.fkeys
+        self.indexes
+        self.comments
+        self.html_attrs
 
     def init_html_attributes(self):
         """Get data from table html_attributes"""
@@ -68,6 +329,8 @@ class Database:
             sql = f"""
             select selector, attributes as attrs
             from {self.schema}.html_attributes
+            where selector not like 'data-cache.%'
+              and selector not like 'data-search.%'
             """
             try:
                 with self.engine.connect() as cnxn:
@@ -79,6 +342,162 @@ class Database:
 
         return attrs
 
+    def get_cache_shard(self, tbl_name):
+        """Return fields and grid of table from data-cache
+
+        These are stored in separate rows in html_attributes, and
+        loaded only for tables used in the request. Caches made before
+        sharding have them in the data-cache itself.
+        """
+        table = self.cache.tables[tbl_name]
+        if not self.cache.sharded:
+            return table
+
+        return self.metadata.fetch(('cache_shard', tbl_name),
+                                   lambda: self.init_cache_shard(tbl_name))
+
+    def init_cache_shard(self, tbl_name):
+        """Read fields and grid of table from html_attributes"""
+        sql = f"""
+        select attributes from {self.schema}.html_attributes
+        where selector = :selector
+        """
+        with self.connect() as cnxn:
+            params = {'selector': 'data-cache.tables.' + tbl_name}
+            attrs_txt = cnxn.execute(text(sql), params).scalar()
+
+        return self.parse_cache_shard(attrs_txt)
+
+    def init_cache_shards(self, tbl_names):
+        """Read fields and grid of several tables in one query"""
+        if not tbl_names:
+            return {}
+        sql = f"""
+        select selector, attributes from {self.schema}.html_attributes
+        where selector like 'data-cache.tables.%'
+        """
+        with self.connect() as cnxn:
+            rows = cnxn.execute(text(sql)).fetchall()
+        attrs = {row[0]: row[1] for row in rows}
+
+        return {
+            tbl_name: self.parse_cache_shard(
+                attrs.get('data-cache.tables.' + tbl_name, None))
+            for tbl_name in tbl_names
+        }
+
+    def parse_cache_shard(self, attrs_txt):
+        """Return shard stored as json, possibly compressed"""
+        if attrs_txt is None:
+            return Dict()
+        if attrs_txt.startswith('zlib:'):
+            attrs_txt = zlib.decompress(base64.b64decode(attrs_txt[5:]))
+
+        return Dict(json.loads(attrs_txt))
+
+    def set_cache_fingerprint(self):
+        """Mark data-cache as made from current schema
+
+        Used after changes to the schema not affecting the cache.
+        """
+        if not self.cache:
+            return
+        sql = f"""
+        select attributes from {self.schema}.html_attributes
+        where selector = 'base'
+        """
+        with self.engine.connect() as cnxn:
+            attrs = Dict(json.loads(cnxn.execute(text(sql)).scalar()))
+            attrs['data-cache'].fingerprint = self.get_fingerprint().catalog
+            sql = f"""
+            update {self.schema}.html_attributes
+            set attributes = :attrs
+            where selector = 'base'
+            """
+            cnxn.execute(text(sql), {'attrs': json.dumps(attrs)})
+            cnxn.commit()
+
+    def save_cache(self, cache):
+        """Write data-cache to html_attributes
+
+        The cache is stored as an index in the row with selector 'base',
+        holding everything but fields and grid of each table, and one
+        row per table with the fields and grid.
+        """
+        compress = cfg.cache_compress
+        shards = []
+        keep = []
+        index = Dict(cache)
+        for tbl_name, table in index.tables.items():
+            if 'fields' not in table:
+                # Table taken from the index of a sharded cache
+                keep.append('data-cache.tables.' + tbl_name)
+                continue
+            shard = json.dumps({'fields': table.pop('fields', None),
+                                'grid': table.pop('grid', None)})
+            if compress:
+                shard = zlib.compress(shard.encode(), 9)
+                shard = 'zlib:' + base64.b64encode(shard).decode()
+            shards.append({
+                'selector': 'data-cache.tables.' + tbl_name,
+                'attrs': shard
+            })
+        index.sharded = True
+
+        sql = """
+        select count(*) from html_attributes
+        where selector = :selector
+        """
+
+        with self.engine.connect() as cnxn:
+            count = cnxn.execute(text(sql), {'selector': 'base'}).first()[0]
+
+        attrs = {
+            'data-cache': index
+        }
+        attrs_txt = json.dumps(attrs)
+
+        if count:
+            sql = """
+            update html_attributes
+            set attributes = :attrs
+            where selector = :selector
+            """
+        else:
+            sql = """
+            insert into html_attributes(attributes, selector)
+            values (:attrs, :selector)
+            """
+
+        with self.engine.connect() as cnxn:
+            params = {
+                'attrs': attrs_txt,
+                'selector': 'base'
+            }
+            cnxn.execute(text(sql), params)
+
+            sql = """
+            select selector from html_attributes
+            where selector like 'data-cache.%'
+            """
+            selectors = cnxn.execute(text(sql)).scalars().all()
+            delete = [{'selector': selector} for selector in selectors
+                      if selector not in keep]
+            if delete:
+                sql = """
+                delete from html_attributes
+                where selector = :selector
+                """
+                cnxn.execute(text(sql), delete)
+
+            if shards:
+                sql = """
+                insert into html_attributes(attributes, selector)
+                values (:attrs, :selector)
+                """
+                cnxn.execute(text(sql), shards)
+            cnxn.commit()
+
     def filter_schema(self, schema):
         system_schemas = [
             'information_schema',
@@ -131,8 +550,12 @@ class Database:
 
     def get_comment(self):
         """Get database comment"""
+        return self.metadata.fetch('db_comment', self.init_comment)
+
+    def init_comment(self):
+        """Read database comment"""
         if self.engine.name in ['mysql', 'mariadb', 'postgresql']:
-            user = User(self.engine)
+            user = User(self.engine, session=self.session)
             comment = user.databases(self.schema, self.cat)[0].db_comment
         else:
             comment = None
@@ -175,15 +598,20 @@ class Database:
             cnxn.commit()
 
         # Refresh attributes
+        self.metadata.discard('html_attrs')
         self.html_attrs = self.init_html_attributes()
         attrs = Dict(self.html_attrs.pop('base', None))
         self.cache = attrs.pop('data-cache', None)
 
-    def get_tables(self):
-        """Return metadata for every table"""
+    def get_tables(self, incremental=False):
+        """Return metadata for every table
+
+        If `incremental` is set when updating cache, metadata from the
+        stored cache is reused for tables that haven't changed.
+        """
 
         # Return metadata from cache if set
-        if (self.cache and not self.config.tables):
+        if (self.cache and not self.config.tables and not incremental):
             self.tables = self.cache.tables
             return self.tables
 
@@ -198,14 +626,30 @@ class Database:
         tbl_names = self.user.tables(self.schema)
         view_names = self.refl.get_view_names(self.schema)
 
-        for tbl_name in self.tablenames:
-            if tbl_name[-5:] == '_view' and tbl_name[:-5] in self.tablenames:
-                continue
+        if self.config.update_cache:
+            fingerprints = self.get_table_fingerprints()
+        if self.config.update_cache and incremental:
+            prev_tables, rowcounts = self.get_unchanged_tables(fingerprints)
+        else:
+            prev_tables, rowcounts = Dict(), {}
 
+        names = [tbl_name for tbl_name in self.tablenames
+                 if not (tbl_name[-5:] == '_view' and
+                         tbl_name[:-5] in self.tablenames)]
+        progress = itertools.count(1)
+
+        def build(tbl_name):
             hidden = tbl_name[0:1] == "_" or tbl_name == 'html_attributes'
 
             table = Table(self, tbl_name)
             grid = Grid(table)
+            prev = prev_tables.get(tbl_name, None)
+            if prev:
+                # Reuse the expensive parts from stored cache
+                table._type = prev.type
+                table._fields = prev.fields
+                table._relations = prev.relations
+                grid._columns = prev.grid.columns
 
             table.main_type = 'table' if tbl_name in (tbl_names) else 'view'
 
@@ -228,20 +672,26 @@ class Database:
                         del self.config.tables[tbl_name]
 
             if self.config.update_cache:
-                table.rowcount = table.count_rows()
+                if tbl_name in rowcounts:
+                    table.rowcount = rowcounts[tbl_name]
+                elif prev:
+                    table.rowcount = prev.rowcount
+                else:
+                    table.rowcount = table.count_rows()
                 space = ' ' * (30 - len(tbl_name))
-                print('Table: ', f"{tbl_name}{space}({table.rowcount})")
+                status = ' unchanged' if prev else ''
+                # Written in one piece so lines from threads don't mix
+                print(f"[{next(progress)}/{len(names)}] Table:  "
+                      f"{tbl_name}{space}({table.rowcount}){status}\n",
+                      end='')
 
             view = tbl_name
             if tbl_name + '_view' in view_names:
                 view = tbl_name + '_view'
 
-            if self.engine.name == 'sqlite' or tbl_name not in self.comments:
-                comment = None
-            else:
-                comment = self.comments[tbl_name]
+            comment = self.comments.get(tbl_name, None)
 
-            self.tables[tbl_name] = Dict({
+            return Dict({
                 'name': tbl_name,
                 'type': table.type,
                 'view': view,
@@ -261,13 +711,258 @@ class Database:
                            else table.fields),
                 'grid': None if not self.config.update_cache else {
                     'columns': grid.columns
-                }
+                },
+                'fingerprint': (None if not self.config.update_cache
+                                else fingerprints[tbl_name])
             })
 
+        # Tables are analysed in parallel when building the data-cache
+        self.prime_metadata()
+        entries = self.map(build, names)
+        for tbl_name, entry in zip(names, entries):
+            self.tables[tbl_name] = entry
+
         return self.tables
 
+    def get_table_fingerprints(self):
+        """Return hashes of columns and constraints for each table
+
+        Used to find which tables are changed since cache was made.
+        Attributes set in html_attributes for the table are included.
+        """
+        def digest(obj):
+            data = json.dumps(obj, sort_keys=True, default=str)
+            return hashlib.md5(data.encode()).hexdigest()
+
+        view_cols = Dict()
+        schema_columns = self.refl.get_multi_columns(self.schema,
+                                                     kind=ObjectKind.VIEW)
+        for (schema, view), cols in schema_columns.items():
+            view_cols[view] = cols
+
+        fingerprints = Dict()
+        for tbl_name in self.tablenames:
+            cols = self.columns.get(tbl_name, None) or view_cols.get(tbl_name)
+            constraints = {
+                'pkey': self.pkeys.get(tbl_name, None),
+                'fkeys': self.fkeys.get(tbl_name, None),
+                'relations': self.relations.get(tbl_name, None),
+                'indexes': self.indexes.get(tbl_name, None)
+            }
+            attrs = {selector: attrs
+                     for selector, attrs in self.html_attrs.items()
+                     if f'"{tbl_name}.' in selector or
+                     f'"{tbl_name}"' in selector}
+            fingerprints[tbl_name] = Dict({
+                'columns': digest(cols),
+                'constraints': digest(constraints),
+                'attrs': digest(attrs)
+            })
+
+        return fingerprints
+
+    def get_unchanged_tables(self, fingerprints):
+        """Return tables from stored cache that need not be rebuilt
+
+        A table is changed if columns or constraints are changed, or if
+        number of rows has changed by more than 10 percent. Tables with
+        foreign keys to a changed table, or relations from it, are also
+        rebuilt, as options and use of relations are based on its rows.
+        Also returns the row counts found.
+        """
+        html_attrs = self.metadata.fetch(
+            'html_attrs', lambda: Dict(self.init_html_attributes()))
+        attrs = html_attrs.get('base', None) or Dict()
+        cache = attrs.get('data-cache', None)
+        if not cache or not cache.tables:
+            print('No stored cache, updating all tables')
+            return Dict(), {}
+        if bool(cache.config.column_use) != bool(self.config.column_use):
+            print('Column use changed, updating all tables')
+            return Dict(), {}
+
+        changed = set()
+        for tbl_name in fingerprints:
+            prev = cache.tables.get(tbl_name, None)
+            if not prev or prev.fingerprint != fingerprints[tbl_name]:
+                changed.add(tbl_name)
+
+        # Rows are counted only for tables without an estimate whose
+        # structure is unchanged, in parallel like the analysis
+        estimates = self.get_rowcount_estimates()
+        names = [tbl_name for tbl_name in fingerprints
+                 if tbl_name not in changed and
+                 estimates.get(tbl_name, None) is None]
+        self.prime_metadata()
+        counts = self.map(lambda name: Table(self, name).count_rows(), names)
+        rowcounts = dict(zip(names, counts))
+        for tbl_name in fingerprints:
+            if tbl_name in changed:
+                continue
+            prev = cache.tables[tbl_name]
+            rowcount = estimates.get(tbl_name, None)
+            if rowcount is None:
+                rowcount = rowcounts[tbl_name]
+            if abs(rowcount - (prev.rowcount or 0)) > 0.1 * (prev.rowcount or 0):
+                changed.add(tbl_name)
+
+        tables = Dict()
+        for tbl_name in fingerprints:
+            if tbl_name in changed:
+                continue
+            prev = cache.tables[tbl_name]
+            related = [fkey.referred_table for fkey in prev.fkeys.values()]
+            related += [rel.table for rel in prev.relations.values()]
+            if changed.intersection(related):
+                continue
+            tables[tbl_name] = prev
+
+        if cache.sharded:
+            shards = self.init_cache_shards(list(tables))
+            for tbl_name, shard in shards.items():
+                table = Dict(tables[tbl_name])
+                table.update(shard)
+                tables[tbl_name] = table
+
+        return tables, rowcounts
+
+    def get_metadata_version(self, tbl_name):
+        """Return version of metadata for table as shown to user
+
+        Changes when the schema or html_attributes are changed. Made
+        only from values read from the database, so that it's the same
+        in all processes, and after the shared metadata expires.
+        """
+        key = json.dumps([self.fingerprint, tbl_name,
+                          self.user.name, self.session.role])
+
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def fetch_result(self, kind, sql, params, build):
+        """Return result of query from cache, or call `build` to get it
+
+        The result is removed when the tables read by the query are
+        written to.
+        """
+        url = self.engine.url.render_as_string(hide_password=True)
+        key = (url, self.schema, kind, sql,
+               json.dumps(params, sort_keys=True, default=str))
+        tables = set(re.findall(r'\w+', sql)) & set(self.tablenames)
+
+        return results.store.fetch(key, tables, build)
+
+    def invalidate_results(self, tables=None):
+        """Remove cached results, pages and lookups depending on tables
+
+        Removes all results for the schema if tables is None.
+        """
+        url = self.engine.url.render_as_string(hide_password=True)
+        if tables is None:
+            results.store.invalidate(url, self.schema)
+            results.pages.invalidate(url, self.schema)
+            lookups.store.invalidate(url, self.schema)
+            return
+
+        # Cascading deletes and updates change referring tables too
+        tables = set(tables)
+        queue = list(tables)
+        while queue:
+            tbl_name = queue.pop()
+            for rel in self.relations[tbl_name].values():
+                if rel.table not in tables:
+                    tables.add(rel.table)
+                    queue.append(rel.table)
+
+        results.store.invalidate(url, self.schema, tables)
+        results.pages.invalidate(url, self.schema, tables)
+        lookups.store.invalidate(url, self.schema, tables)
+
+    def get_rowcount_estimates(self, table=None):
+        """Return estimated number of rows from the database catalog
+
+        Tables missing from statistics are not included.
+
+        Parameters:
+        table: Get estimate only for this table
+        """
+        params = {'schema': self.schema, 'table': table}
+        if self.engine.name == 'postgresql':
+            sql = f"""
+            select c.relname as table_name, c.reltuples as rowcount
+            from pg_class c
+            join pg_namespace n on n.oid = c.relnamespace
+            where n.nspname = :schema and c.relkind in ('r', 'p')
+              and c.reltuples >= 0
+              {'and c.relname = :table' if table else ''}
+            """
+        elif self.engine.name in ['mysql', 'mariadb']:
+            sql = f"""
+            select table_name, table_rows as rowcount
+            from information_schema.tables
+            where table_schema = :schema and table_rows is not null
+              {'and table_name = :table' if table else ''}
+            """
+        elif self.engine.name == 'oracle':
+            sql = f"""
+            select table_name, num_rows as rowcount
+            from all_tables
+            where owner = :schema and num_rows is not null
+              {'and table_name = :table' if table else ''}
+            """
+        elif self.engine.name == 'mssql':
+            sql = f"""
+            select t.name as table_name, sum(p.rows) as rowcount
+            from sys.tables t
+            join sys.partitions p on p.object_id = t.object_id
+            where schema_name(t.schema_id) = :schema
+              and p.index_id in (0, 1)
+              {'and t.name = :table' if table else ''}
+            group by t.name
+            """
+        elif self.engine.name == 'duckdb':
+            sql = f"""
+            select table_name, estimated_size as rowcount
+            from duckdb_tables()
+            where schema_name = :schema
+              {'and table_name = :table' if table else ''}
+            """
+        elif self.engine.name == 'sqlite':
+            # Statistics exist only if database is analyzed
+            sql = """
+            select count(*) from sqlite_master
+            where name = 'sqlite_stat1'
+            """
+            with self.connect() as cnxn:
+                analyzed = cnxn.execute(text(sql)).first()[0]
+            if not analyzed:
+                return {}
+
+            sql = "select tbl, stat from sqlite_stat1"
+            if table:
+                sql += " where tbl = :table"
+            with self.connect() as cnxn:
+                rows = cnxn.execute(text(sql), params).fetchall()
+
+            # First number in stat is number of rows in table
+            return {row.tbl: int(row.stat.split()[0]) for row in rows}
+        else:
+            return {}
+
+        with self.connect() as cnxn:
+            rows = cnxn.execute(text(sql), params).fetchall()
+
+        return {row.table_name: int(row.rowcount) for row in rows}
+
     @property
     def schemas(self):
+        if not hasattr(self, '_schemas'):
+            self._schemas = self.metadata.fetch(('schemas', self.user.name),
+                                                self.init_schemas)
+
+        return self._schemas
+
+    def init_schemas(self):
+        """Return schemas available for user"""
         if self.engine.name == 'postgresql' and not self.user.is_admin(self.schema):
             sql = """
             select table_schema
@@ -282,17 +977,23 @@ class Database:
             }
             with self.engine.connect() as cnxn:
                 rows = cnxn.execute(text(sql), params).fetchall()
-            self._schemas = [row[0] for row in rows]
+            schemas = [row[0] for row in rows]
         else:
-            self._schemas = list(filter(self.filter_schema,
-                                 self.refl.get_schema_names()))
+            schemas = list(filter(self.filter_schema,
+                                  self.refl.get_schema_names()))
 
-        return self._schemas
+        return schemas
 
     @property
     def tablenames(self):
-        if hasattr(self, '_tablenames'):
-            return self._tablenames
+        if not hasattr(self, '_tablenames'):
+            self._tablenames = self.metadata.fetch(
+                ('tablenames', self.user.name), self.init_tablenames)
+
+        return self._tablenames
+
+    def init_tablenames(self):
+        """Return names of tables and views available for user"""
         if self.engine.name == 'postgresql' and not self.user.is_admin(self.schema):
             sql = """
             select table_name
@@ -314,24 +1015,87 @@ class Database:
             with self.engine.connect() as cnxn:
                 params = {'cat': self.cat, 'schema': self.schema}
                 rows = cnxn.execute(text(sql), params).fetchall()
-            self._tablenames = [row[0] for row in rows]
+            tablenames = [row[0] for row in rows]
         else:
             table_names = self.user.tables(self.schema)
             view_names = self.refl.get_view_names(self.schema)
-            self._tablenames = table_names + view_names
+            tablenames = table_names + view_names
 
-        return self._tablenames
+        # Search indexes are not shown as tables
+        return [name for name in tablenames
+                if not name.startswith('_search_')]
+
+    @property
+    def collation(self):
+        """Return default collation of PostgreSQL database"""
+        if not hasattr(self, '_collation'):
+            sql = """
+            select datcollate from pg_database
+            where datname = current_database()
+            """
+            self._collation = self.metadata.fetch(
+                'collation', lambda: self.query_value(sql))
+
+        return self._collation
+
+    def query_value(self, sql):
+        """Return first value from sql"""
+        with self.connect() as cnxn:
+            return cnxn.execute(text(sql)).scalar()
+
+    @property
+    def search_tables(self):
+        """Return names of tables holding search indexes"""
+        if not hasattr(self, '_search_tables'):
+            self._search_tables = self.metadata.fetch(
+                'search_tables', lambda: set(
+                    name for name in self.refl.get_table_names(self.schema)
+                    if name.startswith('_search_')))
+
+        return self._search_tables
+
+    @property
+    def search_info(self):
+        """Return Dict of saved state of search indexes by table"""
+        if not hasattr(self, '_search_info'):
+            self._search_info = self.metadata.fetch(
+                'search_info', self.init_search_info)
+
+        return self._search_info
+
+    def init_search_info(self):
+        """Get state of search indexes from table html_attributes"""
+        info = Dict()
+        if 'html_attributes' not in self.tablenames:
+            return info
+        sql = f"""
+        select selector, attributes as attrs
+        from {self.schema}.html_attributes
+        where selector like 'data-search.%'
+        """
+        with self.connect() as cnxn:
+            rows = cnxn.execute(text(sql)).fetchall()
+        for row in rows:
+            info[row.selector[len('data-search.'):]] = json.loads(row.attrs)
+
+        return info
 
     @property
     def columns(self):
         if not hasattr(self, '_columns'):
-            self._columns = Dict()
-            columns = self.refl.get_multi_columns(self.schema)
-            for (schema, table), cols in columns.items():
-                self._columns[table] = cols
+            self._columns = self.metadata.fetch('columns', self.init_columns)
 
         return self._columns
 
+    def init_columns(self):
+        """Return Dict of reflected columns for each table"""
+        columns = Dict()
+        schema_columns = self.refl.get_multi_columns(self.schema)
+        for (schema, table), cols in schema_columns.items():
+            columns[table] = cols
+
+        return columns
+
     def is_top_level(self, table):
         """Check if table is top level, i.e. not subordinate to other tables"""
         if (table.type == 'list' or table.hidden):
@@ -602,49 +1366,27 @@ class Database:
                         self.get_content_node(tbl_name)
 
         if self.config.update_cache:
-            sql = """
-            select count(*) from html_attributes
-            where selector = :selector
-            """
-
-            with self.engine.connect() as cnxn:
-                count = cnxn.execute(text(sql), {'selector': 'base'}).first()[0]
-
-            cache = {
+            self.save_cache({
                 "tables": self.tables,
                 "contents": contents,
-                "config": self.config
-            }
-            attrs = {
-                'data-cache': cache
-            }
-            attrs_txt = json.dumps(attrs)
-
-            if count:
-                sql = """
-                update html_attributes
-                set attributes = :attrs
-                where selector = :selector
-                """
-            else:
-                sql = """
-                insert into html_attributes(attributes, selector)
-                values (:attrs, :selector)
-                """
-
-            with self.engine.connect() as cnxn:
-                params = {
-                    'attrs': attrs_txt,
-                    'selector': 'base'
-                }
-                cnxn.execute(text(sql), params)
-                cnxn.commit()
+                "config": self.config,
+                "fingerprint": self.get_fingerprint().catalog
+            })
 
         return contents
 
     @property
     def comments(self):
-        self._comments = {}
+        """Return comments of tables"""
+        if not hasattr(self, '_comments'):
+            self._comments = self.metadata.fetch('comments',
+                                                 self.init_comments)
+
+        return self._comments
+
+    def init_comments(self):
+        """Return Dict of table comments, read in one query"""
+        comments = Dict()
         # SQLAlchemy reflection doesn't work for comments in mysql/mariadb
         if self.engine.name in ['mysql', 'mariadb']:
             sql = """
@@ -653,148 +1395,167 @@ class Database:
             where table_schema = :schema
             """
 
-            with self.engine.connect() as cnxn:
+            with self.connect() as cnxn:
                 rows = cnxn.execute(text(sql), {'schema': self.schema})
                 for row in rows:
-                    self._comments[row.table_name] = row.table_comment
-        else:
+                    comments[row.table_name] = row.table_comment
+        elif self.engine.name != 'sqlite':
             rows = self.refl.get_multi_table_comment(self.schema)
             for (schema, table), row in rows.items():
-                self._comments[table] = row['text']
+                comments[table] = row['text']
 
-        return self._comments
+        return comments
 
     @property
     def pkeys(self):
         """Get primary key of table"""
 
         if not hasattr(self, '_pkeys'):
-            self._pkeys = Dict()
-            # reflection of constraints is not implemented for duckdb yet
-            if self.engine.name == 'duckdb':
-                sql = """
-                select * from duckdb_constraints()
-                where constraint_type = 'PRIMARY KEY'
-                """
-                with self.engine.connect() as cnxn:
-                    rows = cnxn.execute(text(sql)).fetchall()
-                    for row in rows:
-                        pkey = Dict({
-                            'table_name': row.table_name,
-                            'name': 'PRIMARY',
-                            'unique': True,
-                            'columns': row.constraint_column_names
-                        })
-                        self._pkeys[row.table_name] = pkey
-            else:
-                pkey_constraints = self.refl.get_multi_pk_constraint(self.schema)
-                for (schema, table), pkey in pkey_constraints.items():
-                    self._pkeys[table] = Dict({
-                        'table_name': table,
-                        'name': pkey['name'] or 'PRIMARY',
+            self._pkeys = self.metadata.fetch('pkeys', self.init_pkeys)
+
+        return self._pkeys
+
+    def init_pkeys(self):
+        """Return Dict of primary keys for all tables"""
+        pkeys = Dict()
+        # reflection of constraints is not implemented for duckdb yet
+        if self.engine.name == 'duckdb':
+            sql = """
+            select * from duckdb_constraints()
+            where constraint_type = 'PRIMARY KEY'
+            """
+            with self.engine.connect() as cnxn:
+                rows = cnxn.execute(text(sql)).fetchall()
+                for row in rows:
+                    pkey = Dict({
+                        'table_name': row.table_name,
+                        'name': 'PRIMARY',
                         'unique': True,
-                        'columns': pkey['constrained_columns']
+                        'columns': row.constraint_column_names
                     })
+                    pkeys[row.table_name] = pkey
+        else:
+            pkey_constraints = self.refl.get_multi_pk_constraint(self.schema)
+            for (schema, table), pkey in pkey_constraints.items():
+                pkeys[table] = Dict({
+                    'table_name': table,
+                    'name': pkey['name'] or 'PRIMARY',
+                    'unique': True,
+                    'columns': pkey['constrained_columns']
+                })
 
-        return self._pkeys
+        return pkeys
 
     @property
     def indexes(self):
         if not hasattr(self, '_indexes'):
-            self._indexes = Dict()
-            if self.engine.name == 'duckdb':
-                sql = "select * from duckdb_indexes()"
-                with self.engine.connect() as cnxn:
-                    rows = cnxn.execute(text(sql)).fetchall()
-                    for row in rows:
-                        idx = Dict({
-                            'table_name': row.table_name,
-                            'name': row.index_name,
-                            'unique': row.is_unique
-                        })
-                        expr = row.sql
-                        x = re.search(r"\bon \w+\s?\(([^)]*)\)", expr)
-                        cols_delim = x.group(1).split(',')
-                        idx.columns = [s.strip() for s in cols_delim]
-                        self._indexes[row.table_name][idx.name] = idx
-                for table, pkey in self.pkeys.items():
-                    self._indexes[table][pkey.name] = pkey
-            else:
-                schema_indexes = self.refl.get_multi_indexes(self.schema)
+            self._indexes = self.metadata.fetch('indexes', self.init_indexes)
 
-                for (schema, table), indexes in schema_indexes.items():
+        return self._indexes
 
-                    for idx in indexes:
-                        idx = Dict(idx)
-                        idx.columns = idx.pop('column_names')
-                        idx.pop('dialect_options', None)
+    def init_indexes(self):
+        """Return Dict of indexes for all tables, including primary keys"""
+        indexes = Dict()
+        if self.engine.name == 'duckdb':
+            sql = "select * from duckdb_indexes()"
+            with self.engine.connect() as cnxn:
+                rows = cnxn.execute(text(sql)).fetchall()
+                for row in rows:
+                    idx = Dict({
+                        'table_name': row.table_name,
+                        'name': row.index_name,
+                        'unique': row.is_unique
+                    })
+                    expr = row.sql
+                    x = re.search(r"\bon \w+\s?\(([^)]*)\)", expr)
+                    cols_delim = x.group(1).split(',')
+                    idx.columns = [s.strip() for s in cols_delim]
+                    indexes[row.table_name][idx.name] = idx
+            for table, pkey in self.pkeys.items():
+                indexes[table][pkey.name] = pkey
+        else:
+            schema_indexes = self.refl.get_multi_indexes(self.schema)
 
-                        self._indexes[table][idx.name] = idx
+            for (schema, table), table_indexes in schema_indexes.items():
 
-                for table in self.pkeys:
-                    pkey = self.pkeys[table]
-                    self._indexes[table][pkey.name] = pkey
+                for idx in table_indexes:
+                    idx = Dict(idx)
+                    idx.columns = idx.pop('column_names')
+                    idx.pop('dialect_options', None)
 
-        return self._indexes
+                    indexes[table][idx.name] = idx
+
+            for table in self.pkeys:
+                pkey = self.pkeys[table]
+                indexes[table][pkey.name] = pkey
+
+        return indexes
 
     @property
     def fkeys(self):
         """Get all foreign keys of table"""
         if not hasattr(self, '_fkeys'):
-            self._fkeys = Dict()
-            self._relations = Dict()
+            self._fkeys, self._relations = self.metadata.fetch(
+                'fkeys', self.init_fkeys)
 
-            if self.engine.name == 'duckdb':
-                sql = """
-                select * from duckdb_constraints()
-                where constraint_type = 'FOREIGN KEY'
-                """
-                with self.engine.connect() as cnxn:
-                    rows = cnxn.execute(text(sql)).fetchall()
-                    for row in rows:
-                        fkey = Dict({
-                            'table': row.table_name,
-                            'constrained_columns': row.constraint_column_names,
-                            'referred_schema': 'main',
-                            'schema': 'main'
-                        })
-                        expr = row.constraint_text
-                        if expr:
-                            x = re.search(r"\bREFERENCES (\w+)", expr)
-                            fkey.referred_table = x.group(1)
-                            x = re.search(r"\bREFERENCES \w+\(([^)]*)\)", expr)
-                            cols_delim = x.group(1).split(',')
-                            fkey.referred_columns = [s.strip() for s in cols_delim]
-                        else:
-                            fkey.referred_table = fkey.table
-                            fkey.referred_columns = self.pkeys[fkey.table].columns
+        return self._fkeys
+
+    def init_fkeys(self):
+        """Return Dicts of foreign keys and relations for all tables"""
+        fkeys = Dict()
+        relations = Dict()
+
+        if self.engine.name == 'duckdb':
+            sql = """
+            select * from duckdb_constraints()
+            where constraint_type = 'FOREIGN KEY'
+            """
+            with self.engine.connect() as cnxn:
+                rows = cnxn.execute(text(sql)).fetchall()
+                for row in rows:
+                    fkey = Dict({
+                        'table': row.table_name,
+                        'constrained_columns': row.constraint_column_names,
+                        'referred_schema': 'main',
+                        'schema': 'main'
+                    })
+                    expr = row.constraint_text
+                    if expr:
+                        x = re.search(r"\bREFERENCES (\w+)", expr)
+                        fkey.referred_table = x.group(1)
+                        x = re.search(r"\bREFERENCES \w+\(([^)]*)\)", expr)
+                        cols_delim = x.group(1).split(',')
+                        fkey.referred_columns = [s.strip() for s in cols_delim]
+                    else:
+                        fkey.referred_table = fkey.table
+                        fkey.referred_columns = self.pkeys[fkey.table].columns
+                    fkey.name = fkey.table + '_'
+                    fkey.name += '_'.join(fkey.constrained_columns)+'_fkey'
+                    fkeys[fkey.table][fkey.name] = fkey
+                    relations[fkey.referred_table][fkey.name] = fkey
+
+        else:
+            schema_fkeys = self.refl.get_multi_foreign_keys(self.schema)
+
+            for key, table_fkeys in schema_fkeys.items():
+                for fkey in table_fkeys:
+                    fkey = Dict(fkey)
+                    fkey.table = key[-1]
+                    fkey.schema = key[0] or self.db.schema
+                    if set(self.pkeys[fkey.table].columns) <= set(fkey.constrained_columns):
+                        fkey.relationship = '1:1'
+                    else:
+                        fkey.relationship = '1:M'
+
+                    # Can't extract constraint names in SQLite
+                    if not fkey.name:
                         fkey.name = fkey.table + '_'
                         fkey.name += '_'.join(fkey.constrained_columns)+'_fkey'
-                        self._fkeys[fkey.table][fkey.name] = fkey
-                        self._relations[fkey.referred_table][fkey.name] = fkey
 
-            else:
-                schema_fkeys = self.refl.get_multi_foreign_keys(self.schema)
-
-                for key, fkeys in schema_fkeys.items():
-                    for fkey in fkeys:
-                        fkey = Dict(fkey)
-                        fkey.table = key[-1]
-                        fkey.schema = key[0] or self.db.schema
-                        if set(self.pkeys[fkey.table].columns) <= set(fkey.constrained_columns):
-                            fkey.relationship = '1:1'
-                        else:
-                            fkey.relationship = '1:M'
-
-                        # Can't extract constraint names in SQLite
-                        if not fkey.name:
-                            fkey.name = fkey.table + '_'
-                            fkey.name += '_'.join(fkey.constrained_columns)+'_fkey'
-
-                        self._fkeys[fkey.table][fkey.name] = Dict(fkey)
-                        self._relations[fkey.referred_table][fkey.name] = Dict(fkey)
+                    fkeys[fkey.table][fkey.name] = Dict(fkey)
+                    relations[fkey.referred_table][fkey.name] = Dict(fkey)
 
-        return self._fkeys
+        return fkeys, relations
 
     @property
     def relations(self):
@@ -843,8 +1604,25 @@ class Database:
 
             cnxn.commit()
 
+        if not result.returns_rows:
+            tables = self.get_written_tables(sql)
+            self.invalidate_results(tables)
+            search.mark_stale(self, tables)
+
         return query
 
+    def get_written_tables(self, sql):
+        """Return tables written to by sql, or None if not known"""
+        try:
+            stmnt = sqlglot.parse_one(sql)
+        except sqlglot.errors.ParseError:
+            return None
+        if not isinstance(stmnt, (sqlglot.exp.Insert, sqlglot.exp.Update,
+                                  sqlglot.exp.Delete)):
+            return None
+
+        return set(tbl.name for tbl in stmnt.find_all(sqlglot.exp.Table))
+
     def export_as_sql(self, dialect: str, include_recs: bool,
                       select_recs: bool):
         """Create sql for exporting a database
@@ -859,7 +1637,8 @@ class Database:
         graph = {}
         self_referring = {}
 
-        tbl_names = self.refl.get_table_names(self.schema)
+        tbl_names = [name for name in self.refl.get_table_names(self.schema)
+                     if name not in self.search_tables]
 
         # Make graph to use in topologic sort
         for tbl_name in tbl_names:
@@ -922,7 +1701,8 @@ class Database:
             else:
                 continue
 
-            tbl = self.tables[tbl_name]
+            # Copied because the tables are shared with other requests
+            tbl = Dict(self.tables[tbl_name])
             if not tbl.fields:
                 table = Table(self, tbl_name)
                 tbl.fields = table.fields
@@ -946,11 +1726,16 @@ class Database:
                     else:
                         continue
 
-                    subtbl = self.tables[subtbl_name]
+                    subtbl = Dict(self.tables[subtbl_name])
+                    table = Table(self, subtbl_name)
 
                     if not subtbl.fields:
-                        table = Table(self, subtbl_name)
                         subtbl.fields = table.fields
+                    # The cache holds only the columns of the grid
+                    if not subtbl.grid or 'sort_columns' not in subtbl.grid:
+                        subtbl.grid = Dict({
+                            'sort_columns': Grid(table).sort_columns
+                        })
 
                     for key, fkey in subtbl.fkeys.items():
                         if fkey.referred_table == tbl.name:
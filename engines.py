@@ -0,0 +1,130 @@
+"""Module for keeping database engines and their connection pools alive"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from sqlalchemy import create_engine, event
+
+
+class EngineRegistry:
+    """Process wide registry of engines keyed by connection parameters
+
+    Engines are kept with their connection pool between requests, and
+    evicted when they have been idle longer than `ttl` seconds, or when
+    the registry holds more than `size` engines (least recently used
+    first).
+    """
+
+    def __init__(self, size=20, ttl=30 * 60):
+        self.size = size
+        self.ttl = ttl
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, url, init_statements=None):
+        """Return engine for key, and whether it was created now
+
+        Parameters:
+        key: tuple of (system, host, database, uid, role)
+        url: url used to create engine if not registered
+        init_statements: statements run on every new pooled connection
+        """
+        init_statements = init_statements or []
+        with self._lock:
+            self.evict()
+            entry = self._engines.get(key, None)
+            setup = (url, init_statements)
+            if entry and (entry.url, entry.statements) != setup:
+                # Password or connection setup changed since engine
+                # was created
+                self._engines.pop(key)
+                entry.engine.dispose()
+                entry = None
+
+            if entry:
+                entry.last_used = time.time()
+                self._engines.move_to_end(key)
+                return entry.engine, False
+
+            engine = create_engine(url, pool_pre_ping=True)
+            if init_statements:
+                self.listen_connect(engine, init_statements)
+            self.listen_error(engine, key)
+            if engine.name == 'sqlite':
+                self.listen_sqlite(engine)
+
+            self._engines[key] = Entry(engine, url, init_statements)
+            while len(self._engines) > self.size:
+                key_lru, entry_lru = self._engines.popitem(last=False)
+                entry_lru.engine.dispose()
+
+        return engine, True
+
+    def listen_connect(self, engine, statements):
+        """Run statements on every connection the pool opens
+
+        This makes sure that state set per connection, like roles and
+        attached databases, is present on all pooled connections.
+        """
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_cnxn, connection_record):
+            cursor = dbapi_cnxn.cursor()
+            for sql in statements:
+                cursor.execute(sql)
+            cursor.close()
+
+    def listen_sqlite(self, engine):
+        """Add md5 function to SQLite connections
+
+        Used for the fingerprint of html_attributes, as SQLite has no
+        hash functions.
+        """
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_cnxn, connection_record):
+            dbapi_cnxn.create_function(
+                'md5', 1, lambda value: None if value is None else
+                hashlib.md5(value.encode()).hexdigest(), deterministic=True)
+
+    def listen_error(self, engine, key):
+        """Discard engine if the pool fails to open a connection
+
+        Credentials are then checked again on next request, so that
+        revoked users or changed passwords are detected. The connections
+        of the engine are closed, unless it's already replaced in the
+        registry.
+        """
+        @event.listens_for(engine, 'handle_error')
+        def on_error(context):
+            if context.connection is None and not context.is_disconnect:
+                with self._lock:
+                    entry = self._engines.get(key, None)
+                    if not entry or entry.engine is not engine:
+                        return
+                    del self._engines[key]
+                engine.dispose()
+
+    def discard(self, key):
+        """Remove engine from registry and close its connections"""
+        with self._lock:
+            entry = self._engines.pop(key, None)
+        if entry:
+            entry.engine.dispose()
+
+    def evict(self):
+        """Remove engines not used within ttl"""
+        now = time.time()
+        for key in list(self._engines):
+            entry = self._engines[key]
+            if now - entry.last_used > self.ttl:
+                del self._engines[key]
+                entry.engine.dispose()
+
+
+class Entry:
+    """Engine registered with its url, setup and time of last use"""
+
+    def __init__(self, engine, url, statements):
+        self.engine = engine
+        self.url = url
+        self.statements = statements
+        self.last_used = time.time()
@@ -0,0 +1,55 @@
+"""Module for running blocking database work outside the event loop"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorRegistry:
+    """Thread pools per database system, and limits per database
+
+    Each database system has its own pool of `size` threads, so that
+    slow queries against one system can't take up the threads used for
+    the others. At most `limit` requests run at once against the same
+    database, and other requests wait for their turn.
+    """
+
+    def __init__(self, size=8, limit=4):
+        self.size = size
+        self.limit = limit
+        self._executors = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def executor(self, system):
+        """Return thread pool for database system"""
+        with self._lock:
+            if system not in self._executors:
+                self._executors[system] = ThreadPoolExecutor(
+                    max_workers=self.size,
+                    thread_name_prefix=f'urdr-{system}')
+
+            return self._executors[system]
+
+    def semaphore(self, key):
+        """Return semaphore limiting concurrent requests for database"""
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = asyncio.Semaphore(self.limit)
+
+            return self._semaphores[key]
+
+    async def run(self, session, base, func, *args):
+        """Run func with args in the pool for the system of session
+
+        Context variables are copied to the thread running func.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args)
+        key = (session.system, session.host, base)
+
+        async with self.semaphore(key):
+            return await loop.run_in_executor(self.executor(session.system),
+                                              call)
@@ -1,6 +1,12 @@
+import re
+import bisect
 from datetime import date, datetime
 from addict import Dict
 from sqlalchemy import text
+from settings import Settings
+import lookups
+
+cfg = Settings()
 
 
 class Field:
@@ -151,8 +157,40 @@ class Field:
 
         return condition, params
 
-    def get_options(self, condition, params):
+    def get_options(self, condition, params, shared=True):
+        """Return options for field, or False if there are more than 200
+
+        Options are shared with fields referring to the same table with
+        the same label and condition, unless `shared` is False. They are
+        cached with the query results, so they are removed when the
+        tables they are read from are written to, or after
+        `result_cache_ttl` seconds.
+        """
+        from_table, pkey_col = self.get_option_source()
+
+        lookup = None if condition else self.get_lookup()
+        if lookup and len(lookup['options']) <= 200:
+            return lookup['options']
+
+        def build():
+            return self.init_options(from_table, pkey_col, condition, params)
+
+        if not shared:
+            return build()
+
+        # Label is independent of the alias of the referred table, and
+        # the tables in the key decide when the options are removed
+        label = re.sub(r'\b' + re.escape(self.name) + r'\.', '.', self.view)
+        key = (f"select {pkey_col}, {label} from {from_table} "
+               f"where {condition or '1=1'}")
 
+        return self.db.fetch_result('options', key, params, build)
+
+    def get_option_source(self):
+        """Return table and column holding the values of the options
+
+        Sets `view` to the expression for the label of the options.
+        """
         fkey = self.tbl.get_fkey(self.name)
 
         if fkey and fkey.referred_table in self.db.tablenames:
@@ -162,27 +200,165 @@ class Field:
             from_table = self.tbl.name
             pkey_col = self.name
 
-        # Field that holds the value of the options
-        value_field = f'{self.name}.' + pkey_col
+        view = None if not fkey else self.get_view(fkey)
+        self.view = view if view else self.name
 
-        condition = condition or '1=1'
+        return from_table, pkey_col
 
-        # Count records
+    def get_typeahead(self, search, condition, params, limit, cursor=None):
+        """Return page of options with label matching search
+
+        Options with label starting with `search` come first, then the
+        ones containing it elsewhere, each sorted by label and value.
+        Returns dict with the options and cursor for the next page,
+        which is None on the last page. The cursor holds rank, label
+        and value of the last option returned.
+        """
+        from_table, pkey_col = self.get_option_source()
+
+        lookup = None if condition else self.get_lookup()
+        if lookup:
+            found = self.search_lookup(lookup, search, limit + 1, cursor)
+        else:
+            found = []
+            start = 0 if not cursor else cursor[0]
+            after = None if not cursor else cursor[1:]
+            for rank in range(start, 2):
+                found += self.search_options(
+                    from_table, pkey_col, condition, params, search, rank,
+                    after, limit + 1 - len(found))
+                after = None
+                if len(found) > limit:
+                    break
+
+        last = found[limit - 1] if len(found) > limit else None
+
+        return {
+            'options': [opt for rank, opt in found[:limit]],
+            'cursor': None if not last else [last[0], last[1]['label'],
+                                             last[1]['value']]
+        }
+
+    def search_options(self, from_table, pkey_col, condition, params,
+                       search, rank, after, limit):
+        """Return options of rank matching search, as (rank, option)
+
+        Rank 0 are labels starting with search, and rank 1 labels
+        containing it elsewhere. Options come after label and value in
+        `after` if given.
+        """
+        from table import Table, Grid
+        value_field = f'{self.name}.' + pkey_col
+        label = self.view or value_field
+        label_text = f"lower(cast({label} as char))"
+        prefix = f"{label_text} like :search_prefix"
+        params = {**params, 'search_prefix': search + '%'}
+        conds = [condition] if condition else []
+
+        # Prefix search on text column made like grid filter, to use index
+        col = re.fullmatch(r'(?:' + re.escape(self.name) + r'\.)?(\w+)',
+                           label)
+        ref_tbl = Table(self.db, from_table)
+        if (
+            rank == 0 and col and col[1] in ref_tbl.fields and
+            ref_tbl.fields[col[1]].datatype == 'str'
+        ):
+            expr, filter_params, _ = Grid(ref_tbl).get_filter_cond(
+                f'{from_table}.{col[1]}', 'LIKE', search + '%')
+            conds.append(expr.replace(f'{from_table}.{col[1]}',
+                                      f'{self.name}.{col[1]}'))
+            params.update(filter_params)
+        elif rank == 0:
+            conds.append(prefix)
+        else:
+            conds.append(f"{label_text} like :search_infix and not {prefix}")
+            params['search_infix'] = '%' + search + '%'
+
+        if after:
+            conds.append(f"({label} > :after_label or ({label} = :after_label"
+                         f" and {value_field} > :after_value))")
+            params.update({'after_label': after[0], 'after_value': after[1]})
 
         sql = f"""
-        select count(*)
-        from {self.db.schema}.{from_table} {self.name}
-        where {condition}
+        select distinct {value_field} as value, {label} as label
+        from   {self.db.schema}.{from_table} {self.name}
+        where  {' and '.join(conds)}
+        order by {label}, {value_field}
         """
+        if self.db.engine.name in ['mssql', 'oracle']:
+            sql += f"offset 0 rows fetch next {limit} rows only"
+        else:
+            sql += f"limit {limit}"
 
-        with self.db.engine.connect() as cnxn:
-            count = cnxn.execute(text(sql), params).first()[0]
+        with self.db.connect() as cnxn:
+            options = cnxn.execute(text(sql), params).all()
 
-        if (count > 200):
-            return False
+        return [(rank, dict(row._mapping)) for row in options]
 
-        view = None if not fkey else self.get_view(fkey)
-        self.view = view if view else self.name
+    def search_lookup(self, lookup, search, limit, cursor=None):
+        """Return options in replica matching search, as (rank, option)
+
+        Labels starting with search are found by bisecting the sorted
+        labels of the replica, and the rest by scanning them.
+        """
+        pattern = re.compile('.*'.join(re.escape(part)
+                                       for part in search.split('%')))
+        prefix = search.split('%')[0]
+        index = lookup['index']
+        keys = []
+        pos = bisect.bisect_left(index, (prefix,))
+        while pos < len(index) and index[pos][0].startswith(prefix):
+            if pattern.match(index[pos][0]):
+                keys.append((0,) + index[pos])
+            pos += 1
+        keys += [(1,) + key for key in index
+                 if not pattern.match(key[0]) and pattern.search(key[0])]
+
+        if cursor:
+            after = (cursor[0], str(cursor[1]).lower(), str(cursor[2]))
+            keys = [key for key in keys if key[:3] > after]
+
+        return [(key[0], lookup['options'][key[3]]) for key in keys[:limit]]
+
+    def get_lookup(self):
+        """Return options and labels from replica of referred table
+
+        Returns None if the referred table is not a 'list' table, or
+        has more than `lookup_rows` rows.
+        """
+        from table import Table
+        fkey = self.tbl.get_fkey(self.name)
+        if (
+            not fkey or len(fkey.constrained_columns) > 1 or
+            fkey.referred_table not in self.db.tablenames or
+            Table(self.db, fkey.referred_table).type != 'list'
+        ):
+            return None
+
+        view = self.get_view(fkey) or self.name
+        pkey_col = fkey.referred_columns[-1]
+        label = re.sub(r'\b' + re.escape(self.name) + r'\.', '.', view)
+        url = self.db.engine.url.render_as_string(hide_password=True)
+        key = (url, self.db.schema, fkey.referred_table, pkey_col, label)
+
+        def build():
+            self.view = view
+            return self.init_options(fkey.referred_table, pkey_col, '', {},
+                                     limit=cfg.lookup_rows)
+
+        return lookups.store.fetch(key, build)
+
+    def init_options(self, from_table, pkey_col, condition, params,
+                     limit=200):
+        """Read options from table, or return False if more than limit
+
+        Reads one row more than the options returned, to find if there
+        are too many options without counting the rows.
+        """
+        # Field that holds the value of the options
+        value_field = f'{self.name}.' + pkey_col
+
+        condition = condition or '1=1'
 
         sql = f"""
         select distinct {value_field} as value,
@@ -191,10 +367,17 @@ class Field:
         where  {condition}
         order by {self.view or value_field}
         """
+        if self.db.engine.name in ['mssql', 'oracle']:
+            sql += f"offset 0 rows fetch next {limit + 1} rows only"
+        else:
+            sql += f"limit {limit + 1}"
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             options = cnxn.execute(text(sql), params).all()
 
+        if len(options) > limit:
+            return False
+
         # Return list of recular python dicts so that it can be
         # json serialized and put in cache
         return [dict(row._mapping) for row in options]
@@ -1,7 +1,15 @@
 import re
 import math
+import time
+from copy import deepcopy
 from addict import Dict
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from settings import Settings
+from search import SearchIndex
+from field import Field
+
+cfg = Settings()
 
 
 class Grid:
@@ -14,8 +22,19 @@ class Grid:
         self.cond = Dict({
             'prep_stmnts': [],
             'params': {},
-            'stmnts': []
+            'stmnts': [],
+            'filters': []
         })
+        # Pagination by 'offset' or 'keyset'. In keyset mode the page
+        # starts after the row with sort key values in `cursor`
+        self.paging = 'offset'
+        self.cursor = None
+        self.keyset = None
+        self.next_cursor = None
+        self.start_cursor = None
+        self.selected_cursor = None
+        self.keyset_params = {}
+        self.count_method = None
 
     def get_select_expression(self, col):
         """Get select expression for column in grid"""
@@ -31,8 +50,12 @@ class Grid:
 
         return select
 
-    def get(self, pkey_vals=None):
-        """Return all metadata and data to display grid"""
+    def get(self, pkey_vals=None, page_only=False):
+        """Return all metadata and data to display grid
+
+        Only data for the page is returned if `page_only` is set, for
+        clients having the metadata from `get_metadata`.
+        """
         selects = {}  # dict of select expressions
 
         for col in self.tbl.pkey.columns:
@@ -43,7 +66,13 @@ class Grid:
             fkey = self.tbl.get_parent_fk()
             rel_column = fkey.constrained_columns[-1]
             ref_column = fkey.referred_columns[-1]
-            selects['count_children'] = self.select_children_count(fkey)
+            # Children are counted for the page from the values of the
+            # referred columns, and with a subquery if they're not shown
+            value_cols = self.tbl.pkey.columns + list(self.columns)
+            count_page = (cfg.children_count != 'subquery' and
+                          set(fkey.referred_columns) <= set(value_cols))
+            if not count_page:
+                selects['count_children'] = self.select_children_count(fkey)
 
             # Filters on highest level if not filtered by user
             if (not self.user_filtered and len(self.cond.prep_stmnts) == 0):
@@ -62,25 +91,70 @@ class Grid:
                 selects[key] = action.disabled
 
         # Uses grid_columns from view if exists
+        labels = {}
         for colname in self.columns:
             col = self.tbl.fields[colname]
             selects[colname] = self.get_select_expression(col)
-
-        display_values = self.get_display_values(selects)
-
-        values = self.get_values(selects)
+            # Labels from replica of lookup table instead of join
+            lookup = None if 'view' not in col else Field(
+                self.tbl, colname).get_lookup()
+            if lookup:
+                labels[colname] = lookup['labels']
+                selects[colname] = col.ref
+
+        self.set_access_cond()
+        if cfg.grid_split_query:
+            display_values = self.get_display_values(selects)
+            values = self.get_values(selects)
+        else:
+            if self.paging == 'keyset':
+                self.keyset = self.get_keyset_columns()
+            display_values, values = self.get_page(selects)
+        if labels:
+            display_values = [self.set_labels(dict(row), labels)
+                              for row in display_values]
         recs = self.get_records(display_values, values)
+        if expansion_column and count_page:
+            counts = self.get_children_counts(fkey, values)
+            for rec, row in zip(recs, values):
+                key = tuple(row[col] for col in fkey.referred_columns)
+                rec['count_children'] = counts.get(key, 0)
 
         data = Dict({
-            'name': self.tbl.name,
-            'type': self.tbl.type,
             'records': recs,
             'count_records': self.get_rowcount(),
-            'fields': self.tbl.fields,
+            'count_method': self.count_method,
             'grid': {
-                'columns': self.columns,
                 'sums': self.get_sums(),
-                'sort_columns': self.sort_columns,
+                'sort_columns': self.sort_columns
+            },
+            'limit': self.tbl.limit,
+            'offset': self.tbl.offset,
+            'selection': self.get_selected_idx(pkey_vals, selects),
+            'paging': 'keyset' if self.keyset else 'offset',
+            'cursor': self.next_cursor,
+            'start_cursor': self.start_cursor,
+            'conditions': self.cond.stmnts,
+            'filters': self.cond.filters
+        })
+
+        if not page_only:
+            metadata = self.get_metadata()
+            data.grid.update(metadata.pop('grid'))
+            data.update(metadata)
+
+        return data
+
+    def get_metadata(self):
+        """Return metadata to display grid, not depending on the page"""
+        actions = self.get_actions()
+
+        return Dict({
+            'name': self.tbl.name,
+            'type': self.tbl.type,
+            'fields': self.get_fields(),
+            'grid': {
+                'columns': self.columns,
                 'actions': ["show_file"] if "show_file" in actions else []
             },
             'form': self.get_form(),
@@ -92,16 +166,36 @@ class Grid:
             'indexes': self.tbl.indexes,
             'label': self.db.get_label(self.tbl.name),
             'actions': actions,
-            'limit': self.tbl.limit,
-            'offset': self.tbl.offset,
-            'selection': self.get_selected_idx(pkey_vals, selects),
-            'conditions': self.cond.stmnts,
-            'expansion_column': expansion_column,
+            'expansion_column': self.get_expansion_column(),
             'relations': self.tbl.relations,
             'saved_filters': []  # Needed in frontend
         })
 
-        return data
+    def get_fields(self):
+        """Return fields of table, with options for foreign keys
+
+        Options are not kept in the metadata with the fields, as they
+        depend on the records of the referred tables.
+        """
+        fields = self.tbl.fields
+        if self.db.cache and not self.db.config.update_cache:
+            # Options are stored with the fields in the data-cache
+            return fields
+
+        for name, field in fields.items():
+            if 'fkey' in field:
+                fld = Field(self.tbl, name)
+                condition, params = fld.get_condition()
+                field.options = fld.get_options(condition, params)
+
+        return fields
+
+    def set_labels(self, row, labels):
+        """Replace values in row with labels from lookup replicas"""
+        for colname, col_labels in labels.items():
+            row[colname] = col_labels.get(row[colname], row[colname])
+
+        return row
 
     def get_records(self, display_values, values):
         """"Return records from values and display values"""
@@ -124,18 +218,81 @@ class Grid:
         return recs
 
     def get_selected_idx(self, pkey_vals, selects):
-        """Return rowindex for record selected in frontend"""
+        """Return rowindex for record selected in frontend
+
+        The position of the record is found by counting the rows sorted
+        before it, which can use an index on the sort columns. Grids
+        without a unique sort order not allowing nulls number all rows
+        with a window function instead.
+        """
         if not pkey_vals:
             return None
 
+        keyset = self.keyset or self.get_keyset_columns()
+        if keyset:
+            idx = self.seek_selected_idx(pkey_vals, keyset)
+        else:
+            idx = self.scan_selected_idx(pkey_vals)
+
+        if idx is not None:
+            page_nr = math.floor(idx / self.tbl.limit)
+            self.tbl.offset = page_nr * self.tbl.limit
+            row_idx = idx - self.tbl.offset
+        else:
+            row_idx = 0
+
+        if self.keyset and idx is not None and self.tbl.offset:
+            self.start_cursor = self.get_cursor_before(idx - self.tbl.offset)
+
+        return row_idx
+
+    def seek_selected_idx(self, pkey_vals, keyset):
+        """Return index of selected record by counting rows before it"""
+        cond = self.get_cond_expr()
+        keys = [f'{key.expr} as key_{idx}' for idx, key in enumerate(keyset)]
+        rec_conds = [f"{self.tbl.view}.{colname} = :{colname}"
+                     for colname in pkey_vals]
+        conds = rec_conds + ([cond] if cond else [])
+        cte = self.db.cte_access if self.tbl.get_access_code_idx() else ''
+
+        sql = cte + f"""
+        select {', '.join(keys)}
+        from   {self.db.schema}.{self.tbl.view}
+        {self.tbl.get_joins(cond, *keys)}
+        where  {' and '.join(f'({cond})' for cond in conds)}
+        """
+
+        params = {**self.cond.params, **pkey_vals}
+        with self.db.connect() as cnxn:
+            row = cnxn.execute(text(sql), params).fetchone()
+        if row is None:
+            return None
+
+        # Selected record is the cursor for rows before it
+        self.selected_cursor = list(row)
+        before, key_params = self.get_keyset_cond(keyset, self.selected_cursor,
+                                                  before=True)
+        where = before if not cond else f"({cond}) and {before}"
+
+        sql = cte + f"""
+        select count(*)
+        from   {self.db.schema}.{self.tbl.view}
+        {self.tbl.get_joins(where)}
+        where  {where}
+        """
+
+        params = {**self.cond.params, **key_params}
+        with self.db.connect() as cnxn:
+            return cnxn.execute(text(sql), params).first()[0]
+
+    def scan_selected_idx(self, pkey_vals):
+        """Return index of selected record by numbering all rows"""
         prep_stmnts = []
         params = {}
         for colname, value in pkey_vals.items():
             prep_stmnts.append(f"{colname} = :{colname}")
             params[colname] = value
 
-        # rec_conds = [f"{colname} = '{value}'" for colname, value
-        #              in pkey_vals.items()]
         rec_cond = " WHERE " + " AND ".join(prep_stmnts)
 
         cond = ''
@@ -143,29 +300,61 @@ class Grid:
             cond = "WHERE " + " AND ".join(self.cond.prep_stmnts)
 
         order_by = self.make_order_by()
+        joins = self.tbl.get_joins(order_by, cond)
 
         sql = f"""
         select rownum - 1
         from   (select row_number() over ({order_by}) as rownum,
                        {self.tbl.view}.*
                 from   {self.tbl.view}
-                {self.tbl.joins}
+                {joins}
                 {cond}) tab
         {rec_cond};
         """
 
-        params = self.cond.params + params
-        with self.db.engine.connect() as cnxn:
+        params = {**self.cond.params, **params}
+        with self.db.connect() as cnxn:
             row = cnxn.execute(text(sql), params).fetchone()
-        idx = row[0] if row else None
-        if idx is not None:
-            page_nr = math.floor(idx / self.tbl.limit)
-            self.tbl.offset = page_nr * self.tbl.limit
-            row_idx = idx - self.tbl.offset
+
+        return row[0] if row else None
+
+    def get_cursor_before(self, count):
+        """Return keyset cursor of row `count` rows before selected
+
+        The cursor of the row before the page holding the selected
+        record is used to fetch that page in keyset mode. It's found by
+        stepping backwards from the selected record, so no more rows
+        than a page are read.
+        """
+        cond = self.get_cond_expr()
+        keys = [f'{key.expr} as key_{idx}'
+                for idx, key in enumerate(self.keyset)]
+        before, params = self.get_keyset_cond(self.keyset,
+                                               self.selected_cursor,
+                                               before=True)
+        where = before if not cond else f"({cond}) and {before}"
+        order_by = "order by " + ', '.join(
+            f"{key.expr} {'DESC' if key.dir == 'ASC' else 'ASC'}"
+            for key in self.keyset)
+
+        sql = self.db.cte_access if self.tbl.get_access_code_idx() else ''
+        sql += f"""
+        select {', '.join(keys)}
+        from   {self.db.schema}.{self.tbl.view}
+        {self.tbl.get_joins(where, order_by, *keys)}
+        where  {where}
+        {order_by}
+        """
+        if self.db.engine.name in ['mssql', 'oracle']:
+            sql += f"offset {count} rows fetch next 1 rows only"
         else:
-            row_idx = 0
+            sql += f"limit 1 offset {count}"
 
-        return row_idx
+        params = {**self.cond.params, **params}
+        with self.db.connect() as cnxn:
+            row = cnxn.execute(text(sql), params).fetchone()
+
+        return list(row) if row else None
 
     def select_children_count(self, fkey):
         """ number of relations to same table for expanding row"""
@@ -183,6 +372,43 @@ class Grid:
             where {where}
             )"""
 
+    def get_children_counts(self, fkey, values):
+        """Return number of children for records on page
+
+        Counts children of all records in one grouped query, instead
+        of a subquery for each record. Returns Dict with tuple of
+        referred column values as key.
+        """
+        if not values:
+            return {}
+
+        params = {}
+        parents = []
+        for idx, row in enumerate(values):
+            conds = []
+            for n, col in enumerate(fkey.constrained_columns):
+                mark = f'parent_{idx}_{n}'
+                params[mark] = row[fkey.referred_columns[n]]
+                conds.append(f"{col} = :{mark}")
+            parents.append("(" + " and ".join(conds) + ")")
+
+        # Records referring to themselves are not children
+        wheres = [f"{col} != {fkey.referred_columns[idx]}"
+                  for idx, col in enumerate(fkey.constrained_columns)]
+        cols = ', '.join(fkey.constrained_columns)
+
+        sql = f"""
+        select {cols}, count(*) as count_children
+        from {self.db.schema}.{self.tbl.name} child_table
+        where ({' or '.join(parents)}) and {' and '.join(wheres)}
+        group by {cols}
+        """
+
+        with self.db.connect() as cnxn:
+            rows = cnxn.execute(text(sql), params).fetchall()
+
+        return {tuple(row[:-1]): row[-1] for row in rows}
+
     def get_expansion_column(self):
         """Return column that should expand a hierarchic table"""
         self_relation = False
@@ -222,22 +448,39 @@ class Grid:
         if hasattr(self, '_columns'):
             return self._columns
         elif self.db.cache:
-            return self.db.cache.tables[self.tbl.name].grid.columns
+            return self.db.get_cache_shard(self.tbl.name).grid.columns
+        elif self.db.config.update_cache:
+            self._columns, virtual_fields = self.init_columns()
+            return self._columns
+
+        columns, virtual_fields = self.db.metadata.fetch(
+            ('grid', self.tbl.name, self.db.user.name), self.init_columns)
+        # Copy fields from view, as values are set on them
+        for field_name, field in virtual_fields.items():
+            self.tbl.fields[field_name] = deepcopy(field)
+        self._columns = columns
+
+        return self._columns
+
+    def init_columns(self):
+        """Return columns of grid, and virtual fields added from views"""
         from table import Table
-        self._columns = []
+        columns = []
+        virtual_fields = Dict()
         has_view = self.tbl.name + '_grid' in self.db.tablenames
         if has_view:
             view_name = self.tbl.name + '_grid'
             view = Table(self.db, view_name)
             cols = self.db.refl.get_columns(view_name)
-            self._columns = [col['name'] for col in cols]
+            columns = [col['name'] for col in cols]
             for field_name, field in view.fields.items():
                 if field_name not in self.tbl.fields:
                     field.virtual = True
                     field.table_name = view_name
                     self.tbl.fields[field_name] = field
+                    virtual_fields[field_name] = field
 
-            return self._columns
+            return columns, virtual_fields
 
         has_view = self.tbl.name + '_view' in self.db.tablenames
         if has_view:
@@ -248,16 +491,17 @@ class Grid:
                     field.virtual = True
                     field.table_name = view_name
                     self.tbl.fields[field_name] = field
+                    virtual_fields[field_name] = field
 
         grid_idx = self.tbl.indexes.get(self.tbl.name + "_grid_idx", None)
         if grid_idx:
-            self._columns = grid_idx.columns
-            return self._columns
+            columns = grid_idx.columns
+            return columns, virtual_fields
 
         fkeys = self.tbl.fkeys
         hidden = self.tbl.is_hidden()
         for key, field in self.tbl.fields.items():
-            if len(self._columns) == 5:
+            if len(columns) == 5:
                 break
             # Don't show hdden columns
             if (
@@ -279,16 +523,82 @@ class Grid:
                 and hidden is False
             ):
                 continue
-            if not (hasattr(field, 'virtual') or (not grid_idx and not len(self._columns) > 4)):
+            if not (hasattr(field, 'virtual') or (not grid_idx and not len(columns) > 4)):
                 continue
             if 'use' in field and (field.use < 0.9 or field.frequency > 0.4):
                 continue
-            self._columns.append(key)
+            columns.append(key)
 
-        return self._columns
+        return columns, virtual_fields
+
+    def get_keyset_columns(self):
+        """Return columns ordering the grid in keyset mode
+
+        Sort columns are followed by the primary key columns, so that
+        the order is unique. Returns None if keyset pagination can't be
+        used, i.e. if a sort column can be null, as nulls can't be
+        compared, or if the table has no primary key.
+        """
+        if not self.tbl.pkey.columns or self.tbl.pkey.columns == ['rowid']:
+            return None
+
+        keys = []
+        for sort in self.sort_columns.values():
+            field = self.tbl.fields.get(sort.col, None)
+            if not field or field.nullable:
+                return None
+            if field.virtual:
+                tbl_name = self.tbl.name + '_grid'
+            else:
+                tbl_name = self.tbl.view
+            keys.append(Dict({
+                'expr': f'{tbl_name}.{sort.col}',
+                'dir': sort.dir.upper()
+            }))
+
+        for colname in self.tbl.pkey.columns:
+            expr = f'{self.tbl.view}.{colname}'
+            if expr not in [key.expr for key in keys]:
+                keys.append(Dict({'expr': expr, 'dir': 'ASC'}))
+
+        return keys
+
+    def get_keyset_cond(self, keyset, cursor, before=False):
+        """Return condition for rows after cursor, and its params
+
+        Uses row value comparison if all columns are sorted in the same
+        direction, and else an expanded comparison that also works in
+        databases without row values. Returns condition for rows before
+        cursor if `before` is set.
+        """
+        params = {f'key_{idx}': value for idx, value in enumerate(cursor)}
+        ascending = 'ASC' if not before else 'DESC'
+        directions = set(key.dir for key in keyset)
+        if (
+            len(directions) == 1 and
+            self.db.engine.name not in ['mssql', 'oracle']
+        ):
+            operator = '>' if ascending in directions else '<'
+            cols = ', '.join(key.expr for key in keyset)
+            marks = ', '.join(f':key_{idx}' for idx in range(len(keyset)))
+
+            return f"({cols}) {operator} ({marks})", params
+
+        conds = []
+        for idx, key in enumerate(keyset):
+            terms = [f"{prev.expr} = :key_{n}"
+                     for n, prev in enumerate(keyset[:idx])]
+            operator = '>' if key.dir == ascending else '<'
+            terms.append(f"{key.expr} {operator} :key_{idx}")
+            conds.append("(" + " and ".join(terms) + ")")
+
+        return "(" + " or ".join(conds) + ")", params
 
     def make_order_by(self):
         """Return 'order by'-clause"""
+        if self.keyset:
+            return "order by " + ', '.join(f"{key.expr} {key.dir}"
+                                           for key in self.keyset)
 
         order = "order by "
         sort_fields = Dict()
@@ -302,110 +612,250 @@ class Grid:
         if (len(self.tbl.pkey.columns) == 0 and len(sort_fields) == 0):
             return ""
 
-        if len(self.sort_columns) == 0:
-            for field in self.tbl.pkey.columns:
+        # Primary key makes the order unique, like the keyset used to
+        # find the position of the selected record
+        for field in self.tbl.pkey.columns:
+            if field not in self.sort_columns:
                 order += f'{self.tbl.view}.{field}, '
 
         order = order[0:-2]
 
         return order
 
-    def get_values(self, selects):
-        """Return values for columns in grid"""
-        cols = []
-        for key in selects.keys():
-            if (
-                (key in self.tbl.fields or key == 'rowid') and
-                'source' not in self.tbl.fields[key]
-            ):
-                cols.append(f'{self.tbl.grid_view}.{key}')
+    def get_value_columns(self, selects):
+        """Return columns in selects that have a raw value"""
+        return [key for key in selects.keys()
+                if (key in self.tbl.fields or key == 'rowid') and
+                'source' not in self.tbl.fields[key]]
 
+    def get_page_sql(self, select):
+        """Return query for current page of grid with given select"""
         sql = ''
         access_idx = self.tbl.get_access_code_idx()
         if access_idx:
             sql += self.db.cte_access
 
-        select = ', '.join(cols)
         cond = self.get_cond_expr()
         order = self.make_order_by()
 
+        # Page starts after cursor in keyset mode
+        offset = self.tbl.offset
+        if self.keyset:
+            offset = 0
+        if self.keyset and self.cursor:
+            keyset_cond, self.keyset_params = self.get_keyset_cond(
+                self.keyset, self.cursor)
+            cond = keyset_cond if not cond else f"({cond}) and {keyset_cond}"
+
         sql += "select " + select + "\n"
         sql += f'from {self.db.schema}.{self.tbl.view}\n'
-        sql += self.tbl.joins
+        sql += self.tbl.get_joins(select, cond, order)
         sql += "" if not cond else "where " + cond + "\n"
         sql += order + "\n"
 
         if self.db.engine.name in ['mssql', 'oracle']:
-            sql += f"offset {self.tbl.offset} rows\n"
+            sql += f"offset {offset} rows\n"
             sql += f"fetch next {self.tbl.limit} rows only"
         else:
-            sql += f"limit {self.tbl.limit} offset {self.tbl.offset}"
+            sql += f"limit {self.tbl.limit} offset {offset}"
+
+        return sql
+
+    def get_page(self, selects):
+        """Return display values and values for grid in one query
 
-        with self.db.engine.connect() as cnxn:
+        Display expressions are selected with the column names as
+        aliases, and the raw values after them with aliases 'value_<n>'.
+        Rows are read by position, so aliases can't collide.
+        """
+        self.set_access_cond()
+        value_cols = self.get_value_columns(selects)
+        display = [f'{value} as {key}' for key, value in selects.items()]
+        raw = [f'{self.tbl.grid_view}.{key} as value_{idx}'
+               for idx, key in enumerate(value_cols)]
+        # Sort keys of last row are used as cursor for next page
+        keys = [] if not self.keyset else [
+            f'{key.expr} as key_{idx}' for idx, key in enumerate(self.keyset)]
+        self.keyset_params = {}
+        sql = self.get_page_sql(', '.join(display + raw + keys))
+        params = {**self.cond.params, **self.keyset_params}
+
+        with self.db.connect() as cnxn:
+            rows = cnxn.execute(text(sql), params).fetchall()
+
+        names = list(selects.keys())
+        end = len(names) + len(value_cols)
+        display_values = []
+        values = []
+        for row in rows:
+            display_values.append(dict(zip(names, row[:len(names)])))
+            values.append(dict(zip(value_cols, row[len(names):end])))
+
+        if self.keyset and rows:
+            self.next_cursor = list(rows[-1][end:])
+
+        return display_values, values
+
+    def get_values(self, selects):
+        """Return values for columns in grid"""
+        self.set_access_cond()
+        cols = [f'{self.tbl.grid_view}.{key}'
+                for key in self.get_value_columns(selects)]
+        sql = self.get_page_sql(', '.join(cols))
+
+        with self.db.connect() as cnxn:
             result = cnxn.execute(text(sql), self.cond.params)
             records = result.mappings().fetchall()
 
         return records
 
     def get_rowcount(self):
-        """Return rowcount for grid"""
+        """Return rowcount for grid, from cache if counted before"""
+        sql = self.get_rowcount_sql()
+        count, self.count_method = self.db.fetch_result(
+            'count', sql, self.cond.params,
+            lambda: (self.count_rows(), self.count_method))
+
+        return count
+
+    def count_rows(self):
+        """Return rowcount for grid
+
+        Unfiltered grids of large tables get the estimate from the
+        database catalog. Else rows are counted within `count_timeout`
+        milliseconds, and if that fails, counted up to `count_limit`.
+        Sets `count_method` to 'estimate', 'exact' or 'limit'.
+        """
+        # The estimate is for the table, so views and inner joins that
+        # can filter rows must be counted
         conds = self.get_cond_expr()
+        if (
+            not conds and self.tbl.view == self.tbl.name and
+            self.tbl.grid_view == self.tbl.view and
+            not self.tbl.get_joins(conds).strip()
+        ):
+            estimate = (self.db.get_rowcount_estimates(self.tbl.name)
+                        .get(self.tbl.name))
+            if estimate is not None and estimate > cfg.count_limit:
+                self.count_method = 'estimate'
+                return estimate
+
+        count = self.get_exact_rowcount()
+        if count is not None:
+            self.count_method = 'exact'
+            return count
+
+        sql = self.get_rowcount_sql(limit=cfg.count_limit + 1)
+        with self.db.connect() as cnxn:
+            count = cnxn.execute(text(sql), self.cond.params).first()[0]
 
-        sql = ''
-        access_idx = self.tbl.get_access_code_idx()
-        if access_idx:
-            sql += self.db.cte_access
+        if count > cfg.count_limit:
+            self.count_method = 'limit'
+            return cfg.count_limit
 
-        if self.db.engine.name == 'sqlite':
-            sql += "select * \n"
-        else:
-            sql += "select count(*)\n"
+        self.count_method = 'exact'
+        return count
+
+    def get_rowcount_sql(self, limit=None):
+        """Return sql counting rows in grid, or at most `limit` rows"""
+        conds = self.get_cond_expr()
+
+        sql = "select count(*)\n" if not limit else "select 1 as n\n"
         sql += f'from {self.db.schema}.{self.tbl.view}\n'
-        sql += self.tbl.joins + "\n"
+        sql += self.tbl.get_joins(conds) + "\n"
         sql += "" if not conds else f"where {conds}\n"
 
-        # Counting can very slow in SQLite, so we limit to 1000
-        if self.db.engine.name == 'sqlite':
-            sql = f"select count(*) from (\n{sql}\nlimit 1000)"
+        if limit and self.db.engine.name in ['mssql', 'oracle']:
+            sql += f"offset 0 rows fetch next {limit} rows only"
+        elif limit:
+            sql += f"limit {limit}"
 
-        with self.db.engine.connect() as cnxn:
-            count = cnxn.execute(text(sql), self.cond.params).first()[0]
+        if limit:
+            sql = f"select count(*) from (\n{sql}\n) tab"
+
+        if self.tbl.get_access_code_idx():
+            sql = self.db.cte_access + sql
+
+        return sql
+
+    def get_exact_rowcount(self):
+        """Return rowcount, or None if counting takes too long
+
+        The time limit is set per statement where the database supports
+        it. Other databases always get the exact count.
+        """
+        sql = self.get_rowcount_sql()
+        timeout = cfg.count_timeout
+        engine = self.db.engine.name
+
+        if engine in ['mysql', 'mariadb']:
+            if engine == 'mysql':
+                sql = sql.replace('select count(*)',
+                                  f'select /*+ MAX_EXECUTION_TIME({timeout}) */'
+                                  ' count(*)', 1)
+            else:
+                sql = (f'SET STATEMENT max_statement_time={timeout / 1000} '
+                       f'FOR {sql}')
+
+        with self.db.connect() as cnxn:
+            try:
+                if engine == 'postgresql':
+                    # Savepoint reverts timeout if count is cancelled
+                    with cnxn.begin_nested():
+                        cnxn.execute(text(f"set local statement_timeout = "
+                                          f"{timeout}"))
+                        count = cnxn.execute(text(sql),
+                                             self.cond.params).first()[0]
+                        cnxn.execute(text("set local statement_timeout "
+                                          "to default"))
+                elif engine == 'sqlite':
+                    dbapi_cnxn = cnxn.connection.dbapi_connection
+                    deadline = time.monotonic() + timeout / 1000
+                    dbapi_cnxn.set_progress_handler(
+                        lambda: time.monotonic() > deadline, 10000)
+                    try:
+                        count = cnxn.execute(text(sql),
+                                             self.cond.params).first()[0]
+                    finally:
+                        dbapi_cnxn.set_progress_handler(None, 0)
+                else:
+                    count = cnxn.execute(text(sql),
+                                         self.cond.params).first()[0]
+            except OperationalError as e:
+                if engine in ['mysql', 'mariadb', 'postgresql', 'sqlite']:
+                    print('Count cancelled:', str(e.orig).splitlines()[0])
+                    return None
+                raise
 
         return count
 
+    def set_access_cond(self):
+        """Add condition limiting records to those user has access to
+
+        Can be called several times, as the condition is added once.
+        """
+        access_idx = self.tbl.get_access_code_idx()
+        if not access_idx or self.cond.access_set:
+            return
+
+        self.cond.params.uid = self.db.user.name
+        col = access_idx.table + '.' + access_idx.columns[-1]
+        stmt = col + ' IS NULL or ' + col + ' in (select code from cte_access)'
+        self.cond.prep_stmnts.append(stmt)
+        self.cond.access_set = True
+
     def get_display_values(self, selects):
         """Return display values for columns in grid"""
+        self.set_access_cond()
 
         alias_selects = {}
         for key, value in selects.items():
             alias_selects[key] = f'{value} as {key}'
         select = ', '.join(alias_selects.values())
 
-        sql = ''
-        access_idx = self.tbl.get_access_code_idx()
-        if access_idx:
-            sql += self.db.cte_access
-            self.cond.params.uid = self.db.user.name
-            col = access_idx.table + '.' + access_idx.columns[-1]
-            stmt = col + ' IS NULL or ' + col + ' in (select code from cte_access)'
-            self.cond.prep_stmnts.append(stmt)
+        sql = self.get_page_sql(select)
 
-        order = self.make_order_by()
-        conds = self.get_cond_expr()
-
-        sql += "select " + select + "\n"
-        sql += f'from {self.db.schema}.{self.tbl.view}\n'
-        sql += self.tbl.joins
-        sql += "" if not conds else "where " + conds + "\n"
-        sql += order + "\n"
-
-        if self.db.engine.name in ['mssql', 'oracle']:
-            sql += f"offset {self.tbl.offset} rows\n"
-            sql += f"fetch next {self.tbl.limit} rows only"
-        else:
-            sql += f"limit {self.tbl.limit} offset {self.tbl.offset}"
-
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             result = cnxn.execute(text(sql), self.cond.params)
             records = result.mappings().fetchall()
 
@@ -427,14 +877,19 @@ class Grid:
 
             sql = "select " + select + "\n"
             sql += f"from {self.tbl.name}\n"
-            sql += self.tbl.joins + "\n"
+            sql += self.tbl.get_joins(select, cond) + "\n"
             sql += "" if not cond else "where " + cond
 
-            with self.db.engine.connect() as cnxn:
-                sums = cnxn.execute(text(sql), params).mappings().first()
+            sums = self.db.fetch_result('sums', sql, params,
+                                        lambda: self.sum_columns(sql, params))
 
         return sums
 
+    def sum_columns(self, sql, params):
+        """Return sums from sql summing columns"""
+        with self.db.connect() as cnxn:
+            return dict(cnxn.execute(text(sql), params).mappings().first())
+
     @property
     def sort_columns(self):
         """Return columns for default sorting of grid"""
@@ -479,6 +934,13 @@ class Grid:
             if len(parts) == 1:
                 # Simple search in any text field
                 value = parts[0]
+                index = SearchIndex(self.tbl)
+                if index.is_current():
+                    expr, params = index.get_cond(value)
+                    if expr:
+                        self.cond.prep_stmnts.append(expr)
+                        self.cond.params.update(params)
+                        continue
                 case_sensitive = value.lower() != value
                 value = '%' + value + "%"
 
@@ -519,20 +981,128 @@ class Grid:
                     if tbl_name + '_view' in self.db.tablenames:
                         field = f"{tbl_name}_view.{field_name}"
 
-                mark = field.replace('.', '_')
                 operator = parts[1].strip()
                 value = parts[2].replace("*", "%")
-                case_sensitive = value.lower() != value
-                field_expr = field
-                if (not case_sensitive and value.lower() != value.upper()):
-                    field_expr = f"lower({field})"
-                if operator == "IN":
-                    value = value.strip().split(",")
-                if value == "":
-                    value = None
-                expr = f"{field_expr} {operator} :{mark}"
+                expr, params, indexed = self.get_filter_cond(field, operator,
+                                                             value)
                 self.cond.prep_stmnts.append(expr)
-                self.cond.params[mark] = value
+                self.cond.params.update(params)
+                self.cond.filters.append({
+                    'filter': fltr,
+                    'condition': expr,
+                    'index': indexed
+                })
+
+    def get_filter_cond(self, field, operator, value):
+        """Return condition for filter on field, its params and if indexed
+
+        Conditions are made so that indexes on the column can be used
+        where that gives the same result. Lowercase values are compared
+        case insensitive, and the column is only wrapped in lower() if
+        its collation is case sensitive. Prefix searches get a range
+        condition if the column is compared byte by byte, and IN lists
+        are bound with one parameter per value.
+        The last value returned tells if an index is expected to be
+        used.
+        """
+        mark = field.replace('.', '_')
+        column = self.get_column_info(*field.split('.', 1))
+        engine = self.db.engine.name
+
+        if operator in ['IS NULL', 'IS NOT NULL']:
+            return f"{field} {operator}", {}, column.indexed
+
+        if value == "":
+            return f"{field} {operator} :{mark}", {mark: None}, False
+
+        case_sensitive = value.lower() != value
+        fold = (not case_sensitive and value.lower() != value.upper() and
+                column.text and not column.nocase)
+        if fold and engine == 'sqlite' and 'LIKE' in operator:
+            # LIKE is already case insensitive in SQLite
+            fold = False
+        field_expr = f"lower({field})" if fold else field
+        indexed = column.lower_indexed if fold else column.indexed
+
+        if operator == 'IN':
+            values = [val.strip() for val in value.split(",")]
+            params = {f"{mark}_{idx}": val for idx, val in enumerate(values)}
+            marks = ', '.join(f":{key}" for key in params)
+            return f"{field_expr} in ({marks})", params, indexed
+
+        expr = f"{field_expr} {operator} :{mark}"
+        params = {mark: value}
+        if operator == 'LIKE':
+            prefix = value[:-1]
+            if (
+                not value.endswith('%') or not prefix or
+                '%' in prefix or '_' in prefix
+            ):
+                return expr, params, False
+            if column.bytewise and engine != 'sqlite':
+                # Strings starting with prefix sort between prefix and
+                # prefix with last character incremented
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                expr = (f"({expr} and {field_expr} >= :{mark}_from "
+                        f"and {field_expr} < :{mark}_to)")
+                params.update({f"{mark}_from": prefix, f"{mark}_to": upper})
+            elif not (
+                engine in ['mysql', 'mariadb', 'mssql', 'oracle'] or
+                (engine == 'sqlite' and column.nocase)
+            ):
+                # Database can't use index for LIKE on this column
+                indexed = False
+        elif operator not in ['=', '<', '>']:
+            indexed = False
+
+        return expr, params, indexed
+
+    def get_column_info(self, tbl_name, col_name):
+        """Return what decides how a filter on column can use indexes
+
+        Only columns of the grid table are looked up, and columns of
+        other tables are treated as text without index.
+        """
+        info = Dict({
+            'text': True,
+            'nocase': False,
+            'bytewise': False,
+            'indexed': False,
+            'lower_indexed': False
+        })
+        if tbl_name not in [self.tbl.name, self.tbl.view]:
+            return info
+
+        field = self.tbl.fields.get(col_name, None)
+        if field:
+            info.text = field.datatype == 'str'
+
+        engine = self.db.engine.name
+        collation = None
+        for col in self.db.refl.get_columns(self.tbl.name, self.db.schema):
+            if col['name'] == col_name:
+                collation = getattr(col['type'], 'collation', None)
+        if engine in ['mysql', 'mariadb', 'mssql']:
+            # Default collations are case insensitive
+            info.nocase = collation is None or '_ci' in collation.lower()
+        elif engine == 'sqlite':
+            info.nocase = (collation or '').upper() == 'NOCASE'
+            info.bytewise = (collation or 'BINARY').upper() == 'BINARY'
+        elif engine == 'postgresql':
+            collation = collation or self.db.collation
+            info.bytewise = collation in ['C', 'POSIX']
+        elif engine == 'duckdb':
+            info.bytewise = collation is None
+
+        for idx in self.tbl.indexes.values():
+            if idx.columns and idx.columns[0] == col_name:
+                info.indexed = True
+            expressions = idx.get('expressions', None) or []
+            if expressions and re.match(r'lower\W*' + re.escape(col_name) +
+                                        r'\b', expressions[0]):
+                info.lower_indexed = True
+
+        return info
 
     def get_cond_expr(self):
         """Return expression with all query conditions"""
@@ -0,0 +1,99 @@
+"""Module for in-memory replicas of lookup tables"""
+import time
+import threading
+from collections import OrderedDict
+from settings import Settings
+
+
+class LookupStore:
+    """Process wide replicas of values and labels of lookup tables
+
+    Foreign keys to small tables of type 'list' get their labels from
+    here, instead of joining the table. Each replica holds the options
+    of a table for one label expression, keyed by engine url, schema,
+    table, value column and label. Holds at most `size` bytes, removing
+    the least recently used replicas, and replicas expire after `ttl`
+    seconds, as tables can be changed by other applications.
+    """
+
+    def __init__(self, size=10 * 1024 * 1024, ttl=10 * 60):
+        self.size = size
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fetch(self, key, build):
+        """Return replica for key, built from options returned by `build`
+
+        The replica is a dict with 'options' as list, 'labels' by value
+        and 'index' with sorted labels. Returns None if `build` returns
+        no options, i.e. if the table has too many rows to be replicated.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry and time.time() - entry['created'] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry['replica']
+
+        self.misses += 1
+        options = build()
+        if options is False:
+            replica = None
+            size = 0
+        else:
+            replica = {
+                'options': options,
+                'labels': {opt['value']: opt['label'] for opt in options},
+                # Lowercase labels with value and position, for search
+                'index': sorted((str(opt['label']).lower(), str(opt['value']),
+                                 n) for n, opt in enumerate(options))
+            }
+            size = 2 * sum(len(str(opt['value'])) + len(str(opt['label']))
+                           for opt in options)
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = {
+                'replica': replica,
+                'bytes': size,
+                'created': time.time()
+            }
+            self.bytes += size
+            while self.bytes > self.size:
+                self._remove(next(iter(self._entries)))
+
+        return replica
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= entry['bytes']
+
+    def invalidate(self, url, schema, tables=None):
+        """Remove replicas for schema of tables, or all replicas"""
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] != url or key[1] != schema:
+                    continue
+                if tables is None or key[2] in tables:
+                    self._remove(key)
+
+    def stats(self):
+        """Return number of hits and misses, and size of replicas"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'replicas': len(self._entries),
+                'bytes': self.bytes,
+                'size': self.size,
+                'ttl': self.ttl
+            }
+
+
+cfg = Settings()
+store = LookupStore(cfg.lookup_size, cfg.lookup_ttl)
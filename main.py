@@ -1,19 +1,27 @@
 import uvicorn
-from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException, Depends
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import (HTMLResponse, JSONResponse, StreamingResponse,
                                FileResponse)
 from fastapi.staticfiles import StaticFiles
+from fastapi.encoders import jsonable_encoder
 from starlette import status
 import io
 import urllib.parse
 import re
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from settings import Settings
+from session import Session
+from engines import EngineRegistry
+from executors import ExecutorRegistry
 from database import Database
+import metadata
+import results
+import lookups
 from table import Table, Grid
 from record import Record
 from field import Field
+from search import SearchIndex
 import json
 import os
 import hashlib
@@ -25,6 +33,8 @@ from user import User
 
 
 cfg = Settings()
+engines = EngineRegistry(cfg.engine_cache_size, cfg.engine_ttl)
+executors = ExecutorRegistry(cfg.executor_size, cfg.database_limit)
 
 app = FastAPI()
 
@@ -34,32 +44,63 @@ templates = Jinja2Templates(directory="static/html")
 mod = os.path.getmtime("static/js/dist/bundle.js")
 
 
-def get_engine(cfg, db_name=None):
+def get_engine(session, db_name=None, check=False):
+    """Return pooled engine for the connection parameters of session
+
+    Credentials are verified when the engine is created, or when
+    `check` is set, e.g. at login.
+    """
     # driver = cfg.driver[cfg.db_system]
-    if cfg.system != 'duckdb':
-        driver = getattr(cfg, f'{cfg.system}_driver')
+    if session.system != 'duckdb':
+        driver = getattr(cfg, f'{session.system}_driver')
 
-    if cfg.system == 'duckdb':
-        path = os.path.join(cfg.host, db_name)
+    if session.system == 'duckdb':
+        path = os.path.join(session.host, db_name)
         url = f"duckdb:///{path}"
-    elif cfg.system == 'sqlite':
-        path = os.path.join(cfg.host, db_name)
+    elif session.system == 'sqlite':
+        path = os.path.join(session.host, db_name)
         url = f"sqlite+{driver}:///{path}"
-    elif cfg.system == 'oracle':
-        parts = cfg.host.split('/')
-        url = f"{cfg.system}+{driver}://{cfg.uid}:{cfg.pwd}@{parts[0]}"
+    elif session.system == 'oracle':
+        parts = session.host.split('/')
+        url = (f"{session.system}+{driver}://{session.uid}:{session.pwd}"
+               f"@{parts[0]}")
         if len(parts) > 1:
             url += '?service_name=' + parts[1]
     else:
-        url = f"{cfg.system}+{driver}://{cfg.uid}:{cfg.pwd}@{cfg.host}"
+        url = (f"{session.system}+{driver}://{session.uid}:{session.pwd}"
+               f"@{session.host}")
         if db_name:
             path = db_name.split('.')
             url += '/' + path[0]
-        elif cfg.system == 'postgresql':
+        elif session.system == 'postgresql':
             url += '/postgres'
 
-    engine = create_engine(url)
+    # Statements that must be run on every pooled connection
+    init_statements = []
+    if session.system in ['mysql', 'mariadb'] and session.role:
+        init_statements.append('set role ' + session.role)
+    elif (
+        session.system == 'sqlite' and session.database == 'urdr.db' and
+        db_name != 'urdr.db'
+    ):
+        path = os.path.join(session.host, session.database)
+        init_statements.append('ATTACH DATABASE "' + path + '" as urdr')
+
+    key = (session.system, session.host, db_name, session.uid, session.role)
+    engine, created = engines.get(key, url, init_statements)
+
+    if created or check:
+        try:
+            check_login_credentials(engine, session, db_name)
+        except HTTPException:
+            engines.discard(key)
+            raise
 
+    return engine
+
+
+def check_login_credentials(engine, session, db_name):
+    """Raise exception if credentials are not valid"""
     try:
         with engine.connect():
             pass
@@ -70,15 +111,16 @@ def get_engine(cfg, db_name=None):
             detail="Invalid authentication"
         )
 
-    if cfg.system == 'sqlite' and db_name == 'urdr.db':
+    if session.system == 'sqlite' and db_name == 'urdr.db':
         with engine.connect() as conn:
             sql = """
             select count(*) from user
             where id = :id and password = :pwd
             """
 
-            hashed_pwd = hashlib.sha256(cfg.pwd.encode('utf-8')).hexdigest()
-            params = {'id': cfg.uid, 'pwd': hashed_pwd}
+            hashed_pwd = hashlib.sha256(session.pwd.encode('utf-8'))
+            hashed_pwd = hashed_pwd.hexdigest()
+            params = {'id': session.uid, 'pwd': hashed_pwd}
             count = conn.execute(text(sql), params).first()[0]
 
             if count == 0:
@@ -86,41 +128,47 @@ def get_engine(cfg, db_name=None):
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail={
                         'msg': "Invalid authentication",
-                        "system": cfg.system,
-                        "host": cfg.host,
-                        "database": cfg.database
+                        "system": session.system,
+                        "host": session.host,
+                        "database": session.database
                     }
                 )
-    elif cfg.system == 'sqlite' and cfg.database == 'urdr.db':
-        with engine.connect() as cnxn:
-            path = os.path.join(cfg.host, cfg.database)
-            cnxn.execute(text('ATTACH DATABASE "' + path + '" as urdr'))
-
-    return engine
 
 
-def token():
+def token(session):
     return jwt.encode({
-        "system": cfg.system,
-        "server": cfg.host,
-        "uid": cfg.uid,
-        "pwd": cfg.pwd,
-        "database": cfg.database,
+        "system": session.system,
+        "server": session.host,
+        "uid": session.uid,
+        "pwd": session.pwd,
+        "database": session.database,
+        "role": session.role,
+        "timeout": session.timeout,
         "timestamp": time.time()
     }, cfg.secret_key)
 
 
+def get_session(request: Request):
+    """Return session of the logged in user, set by `check_login`"""
+    return request.state.session
+
+
 @app.middleware("http")
 async def check_login(request: Request, call_next):
-    session: str = request.cookies.get("session")
-
-    if session:
-        payload = jwt.decode(session, cfg.secret_key)
-        cfg.system = payload["system"]
-        cfg.host = payload["server"]
-        cfg.uid = payload["uid"]
-        cfg.pwd = payload["pwd"]
-        cfg.database = payload["database"]
+    cookie: str = request.cookies.get("session")
+    request.state.session = None
+
+    if cookie:
+        payload = jwt.decode(cookie, cfg.secret_key)
+        request.state.session = Session(
+            system=payload["system"],
+            host=payload["server"],
+            uid=payload["uid"],
+            pwd=payload["pwd"],
+            database=payload["database"],
+            role=payload.get("role", None),
+            timeout=payload.get("timeout", cfg.timeout)
+        )
     elif (
         request.url.path not in ("/login", "/") and
         not request.url.path.startswith('/static')
@@ -135,62 +183,78 @@ async def check_login(request: Request, call_next):
         }, status_code=401)
 
     response = await call_next(request)
+    # Read session again, as it is replaced if user changes role
+    session = request.state.session
     if (
-        cfg.uid and request.url.path not in ["/logout", "/"]
+        session and session.uid and
+        request.url.path not in ["/login", "/logout", "/"]
         and not request.url.path.startswith('/static')
     ):
         # Update cookie to renew expiration time
-        response.set_cookie(key="session", value=token(), expires=cfg.timeout)
+        response.set_cookie(key="session", value=token(session),
+                            expires=session.timeout)
 
     return response
 
 
 @app.get("/", response_class=HTMLResponse)
-def home(request: Request):
+def home(request: Request, session: Session = Depends(get_session)):
     return templates.TemplateResponse("urd.html", {
-        "request": request, "v": mod, "base": cfg.database
+        "request": request, "v": mod,
+        "base": session.database if session else cfg.database
     })
 
 
 @app.post("/login")
 def login(response: Response, system: str, server: str, username: str,
           password: str, database: str):
-    cfg.system = system
-    cfg.uid = username
-    cfg.pwd = password
-    cfg.database = database
-    cfg.host = server or 'localhost'
-
     # cfg.timeout = None if cfg.system == 'sqlite' else cfg.timeout
-    if cfg.system == 'sqlite' and cfg.database != 'urdr.db':
-        cfg.timeout = None
-    response.set_cookie(key="session", value=token(), expires=cfg.timeout)
+    timeout = cfg.timeout
+    if system == 'sqlite' and database != 'urdr.db':
+        timeout = None
+
+    session = Session(
+        system=system,
+        uid=username,
+        pwd=password,
+        database=database,
+        host=server or 'localhost',
+        timeout=timeout
+    )
+
+    # Verify credentials, and keep the engine for the coming requests
+    if session.system not in ('sqlite', 'duckdb'):
+        get_engine(session, check=True)
+    elif session.database:
+        get_engine(session, session.database, check=True)
+
+    response.set_cookie(key="session", value=token(session),
+                        expires=session.timeout)
 
     return {"success": True}
 
 
 @app.get("/logout")
-def logout(response: Response):
+def logout(response: Response, session: Session = Depends(get_session)):
     response.delete_cookie("session")
-    cfg.uid = None
-    cfg.pwd = None
     cnxn = {
-        'system': cfg.system,
-        'host': cfg.host,
-        'database': cfg.database
+        'system': session.system,
+        'host': session.host,
+        'database': session.database
     }
 
     return {'success': True, 'cnxn': cnxn}
 
 
 @app.get("/dblist")
-def dblist(role: str = None):
+def dblist(request: Request, role: str = None,
+           session: Session = Depends(get_session)):
     result = []
     useradmin = False
-    if cfg.system in ('sqlite', 'duckdb'):
-        if cfg.database == 'urdr.db':
-            engine = get_engine(cfg, 'urdr.db')
-            user = User(engine, name=cfg.uid)
+    if session.system in ('sqlite', 'duckdb'):
+        if session.database == 'urdr.db':
+            engine = get_engine(session, 'urdr.db')
+            user = User(engine, name=session.uid, session=session)
             rows = user.databases()
 
             for row in rows:
@@ -201,9 +265,9 @@ def dblist(role: str = None):
                 result.append(base)
 
         else:
-            file_list = os.listdir(cfg.host)
+            file_list = os.listdir(session.host)
             for filename in file_list:
-                attrs = xattr.xattr(cfg.host + '/' + filename)
+                attrs = xattr.xattr(session.host + '/' + filename)
                 comment = None
                 if 'user.comment' in attrs:
                     comment = attrs.get('user.comment')
@@ -215,11 +279,16 @@ def dblist(role: str = None):
                 base.columns.description = comment
                 result.append(base)
     else:
-        engine = get_engine(cfg)
+        engine = get_engine(session)
         if role:
             with engine.connect() as conn:
                 conn.execute(text('set default role ' + role))
-        elif cfg.system in ['mysql', 'mariadb']:
+            # Role is set on all pooled connections of the role's engine,
+            # and kept in the session cookie for the coming requests
+            session = session.model_copy(update={'role': role})
+            request.state.session = session
+            engine = get_engine(session)
+        elif session.system in ['mysql', 'mariadb']:
             sql = 'select current_role()'
             with engine.connect() as conn:
                 rows = conn.execute(text(sql)).fetchall()
@@ -229,7 +298,7 @@ def dblist(role: str = None):
                 if role:
                     conn.execute(text('set role ' + role))
 
-        user = User(engine)
+        user = User(engine, session=session)
         rows = user.databases()
 
         for row in rows:
@@ -240,7 +309,7 @@ def dblist(role: str = None):
             result.append(base)
 
         # Find if user has useradmin privileges
-        if cfg.system in ['mysql', 'mariadb']:
+        if session.system in ['mysql', 'mariadb']:
             with engine.connect() as cnxn:
                 rows = cnxn.execute(text('show grants')).fetchall()
             for row in rows:
@@ -257,18 +326,18 @@ def dblist(role: str = None):
 
     return {'data': {
         'records': result,
-        'roles': [] if cfg.system in ('sqlite', 'duckdb') else user.roles,
+        'roles': [] if session.system in ('sqlite', 'duckdb') else user.roles,
         'role': role,
         'useradmin': useradmin,
-        'system': cfg.system
+        'system': session.system
     }}
 
 
 @app.get("/userlist")
-def userlist():
+def userlist(session: Session = Depends(get_session)):
     users = []
     roles = []
-    engine = get_engine(cfg)
+    engine = get_engine(session)
     with engine.connect() as cnxn:
         if engine.name in ['mysql', 'mariadb']:
             sql = """
@@ -302,16 +371,18 @@ def userlist():
 
 
 @app.get("/user_roles")
-def user_roles(user: str, host: str):
-    engine = get_engine(cfg)
-    user = User(engine, user)
+def user_roles(user: str, host: str,
+               session: Session = Depends(get_session)):
+    engine = get_engine(session)
+    user = User(engine, user, session=session)
 
     return {'data': user.roles}
 
 
 @app.put("/change_user_role")
-def change_role(user: str, host: str, role: str, grant: bool):
-    engine = get_engine(cfg)
+def change_role(user: str, host: str, role: str, grant: bool,
+                session: Session = Depends(get_session)):
+    engine = get_engine(session)
     if grant:
         sql = f'grant {role} to {user}@{host}'
     else:
@@ -322,27 +393,31 @@ def change_role(user: str, host: str, role: str, grant: bool):
 
 
 @app.put("/change_password")
-def change_password(base: str, old_pwd: str, new_pwd: str):
-    if old_pwd != cfg.pwd:
+def change_password(base: str, old_pwd: str, new_pwd: str,
+                    session: Session = Depends(get_session)):
+    if old_pwd != session.pwd:
         return {'data': 'Feil passord'}
-    elif cfg.system in ['mysql', 'mariadb']:
-        cfg2 = Settings()
-        if None in [cfg2.system, cfg2.host, cfg2.uid, cfg2.pwd]:
+    elif session.system in ['mysql', 'mariadb']:
+        # Password is changed by the administrator set in environment
+        if None in [cfg.system, cfg.host, cfg.uid, cfg.pwd]:
             return {'data': 'Påloggingsdata mangler. Kontakt administrator.'}
-        engine = get_engine(cfg2)
+        admin = Session(system=cfg.system, host=cfg.host, uid=cfg.uid,
+                        pwd=cfg.pwd)
+        engine = get_engine(admin)
         with engine.connect() as cnxn:
-            sql = f"alter user {cfg.uid}@{cfg.host} identified by '{new_pwd}'"
+            sql = (f"alter user {session.uid}@{session.host} "
+                   f"identified by '{new_pwd}'")
             cnxn.execute(text(sql))
             cnxn.commit()
 
         return {'data': 'Passord endret'}
-    elif cfg.system == 'sqlite' and cfg.database == 'urdr.db':
-        engine = get_engine(cfg, base)
+    elif session.system == 'sqlite' and session.database == 'urdr.db':
+        engine = get_engine(session, base)
         db_path = engine.url.database
         urdr = 'main' if db_path.endswith('/urdr.db') else 'urdr'
         sql = f"update {urdr}.user set password = :pwd where id = :uid"
         pwd = hashlib.sha256(new_pwd.encode('utf-8')).hexdigest()
-        params = {'uid': cfg.uid, 'pwd': pwd}
+        params = {'uid': session.uid, 'pwd': pwd}
         with engine.connect() as cnxn:
             cnxn.execute(text(sql), params)
             cnxn.commit()
@@ -353,143 +428,261 @@ def change_password(base: str, old_pwd: str, new_pwd: str):
 
 
 @app.put("/create_user")
-def create_user(name: str, pwd: str):
-    engine = get_engine(cfg)
-    if cfg.system in ['mysql', 'mariadb']:
-        sql = f"create user '{name}'@'{cfg.host}' identified by '{pwd}'"
+def create_user(name: str, pwd: str,
+                session: Session = Depends(get_session)):
+    engine = get_engine(session)
+    if session.system in ['mysql', 'mariadb']:
+        sql = f"create user '{name}'@'{session.host}' identified by '{pwd}'"
         with engine.connect() as cnxn:
             cnxn.execute(text(sql))
             cnxn.commit()
 
-        return userlist()
+        return userlist(session)
 
 
 @app.get("/database")
-def db_info(base: str):
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+def db_info(base: str, session: Session = Depends(get_session)):
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
     info = dbo.get_info()
 
     return {'data': info}
 
 
 @app.get("/table")
-async def get_table(request: Request):
+async def get_table(request: Request,
+                    session: Session = Depends(get_session)):
     req = Dict({item[0]: item[1]
                 for item in request.query_params.multi_items()})
-    engine = get_engine(cfg, req.base)
+    body, hit = await executors.run(session, req.base, read_table, req,
+                                    session)
+
+    return Response(content=body, media_type='application/json',
+                    headers={'X-Cache': 'HIT' if hit else 'MISS'})
+
+
+def read_table(req, session):
+    """Return serialized response for /table, and if it was cached
+
+    Responses are cached by user, role and request, until the tables
+    they are read from are written to.
+    """
+    engine = get_engine(session, req.base)
     schema = req.get('schema', None)
-    if cfg.system == 'postgresql' and schema:
+    if session.system == 'postgresql' and schema:
         base_path = req.base + '.' + req.schema
     else:
         base_path = req.base or schema
-    dbo = Database(engine, base_path, cfg.uid)
-    table = Table(dbo, req.table)
-    privilege = dbo.user.table_privilege(req.base, req.table)
+    # Count and records are read from the same snapshot
+    with Database.open(engine, base_path, session, snapshot=True) as dbo:
+        table = Table(dbo, req.table)
+        privilege = dbo.user.table_privilege(req.base, req.table)
+        if privilege.select == 0:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="No access"
+            )
+        # Clients having current metadata get only data for the page
+        version = dbo.get_metadata_version(req.table)
+        page_only = req.get('metadata_version', None) == version
+
+        # The url doesn't hold the user for file databases like SQLite
+        url = engine.url.render_as_string(hide_password=True)
+        key = (url, dbo.schema, session.uid, session.role, version,
+               json.dumps(req, sort_keys=True))
+        body = results.pages.get(key)
+        if body is not None:
+            return body, True
+        generation = results.pages.generation()
+
+        grid = Grid(table)
+        table.limit = int(req.get('limit', 30))
+        table.offset = int(req.get('offset', 0))
+
+        if req.get('filter', None):
+            req['filter'] = urllib.parse.unquote(req['filter'])
+            if req['filter'].startswith('where '):
+                where = req['filter'][6:].split(';')[0]
+                grid.cond.prep_stmnts.append(where)
+            else:
+                grid.set_search_cond(req['filter'])
+
+        if req.get('sort', None):
+            grid.sort_columns = Dict(json.loads(req.sort))
+
+        if req.get('paging', None) == 'keyset':
+            grid.paging = 'keyset'
+            if req.get('cursor', None):
+                grid.cursor = json.loads(req.cursor)
+
+        # todo: handle sort
+        pkey_vals = None
+        if ('prim_key' in req and req.prim_key):
+            pkey_vals = json.loads(req.prim_key)
+
+        data = grid.get(pkey_vals, page_only)
+        data.metadata_version = version
+
+        body = JSONResponse({'data': jsonable_encoder(data)}).body
+        tables = {table.name, table.view, table.grid_view}
+        tables.update(fkey.referred_table for fkey in table.fkeys.values())
+        tables.update(rel.table for rel in table.relations.values())
+        results.pages.put(key, body, tables, generation)
+
+        return body, False
+
+
+@app.get("/table_metadata")
+def table_metadata(request: Request, base: str, table: str,
+                   schema: str = None,
+                   session: Session = Depends(get_session)):
+    """Return metadata of grid, with version as ETag
+
+    Returns 304 Not Modified if the version in If-None-Match is current.
+    """
+    engine = get_engine(session, base)
+    if session.system == 'postgresql' and schema:
+        base_path = base + '.' + schema
+    else:
+        base_path = base or schema
+    dbo = Database(engine, base_path, session)
+    privilege = dbo.user.table_privilege(base, table)
     if privilege.select == 0:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No access"
         )
-    grid = Grid(table)
-    table.limit = int(req.get('limit', 30))
-    table.offset = int(req.get('offset', 0))
-
-    if req.get('filter', None):
-        req['filter'] = urllib.parse.unquote(req['filter'])
-        if req['filter'].startswith('where '):
-            where = req['filter'][6:].split(';')[0]
-            grid.cond.prep_stmnts.append(where)
-        else:
-            grid.set_search_cond(req['filter'])
+    version = dbo.get_metadata_version(table)
+    etag = f'"{version}"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if request.headers.get('if-none-match', None) == etag:
+        return Response(status_code=304, headers=headers)
 
-    if req.get('sort', None):
-        grid.sort_columns = Dict(json.loads(req.sort))
+    grid = Grid(Table(dbo, table))
+    data = grid.get_metadata()
+    data.metadata_version = version
 
-    # todo: handle sort
-    pkey_vals = None
-    if ('prim_key' in req and req.prim_key):
-        pkey_vals = json.loads(req.prim_key)
-    return {'data': grid.get(pkey_vals)}
+    return JSONResponse({'data': jsonable_encoder(data)}, headers=headers)
 
 
 @app.get("/record")
-def get_record(base: str, table: str, pkey: str, schema: str = None):
-    engine = get_engine(cfg, base)
-    if cfg.system == 'postgresql' and schema:
+def get_record(base: str, table: str, pkey: str, schema: str = None,
+               session: Session = Depends(get_session)):
+    engine = get_engine(session, base)
+    if session.system == 'postgresql' and schema:
         base_path = base + '.' + schema
     else:
         base_path = base or schema
-    dbo = Database(engine, base_path, cfg.uid)
-    tbl = Table(dbo, table)
-    pk = json.loads(pkey)
-    record = Record(dbo, tbl, pk)
-    return {'data': record.get()}
+    with Database.open(engine, base_path, session, snapshot=True) as dbo:
+        tbl = Table(dbo, table)
+        pk = json.loads(pkey)
+        record = Record(dbo, tbl, pk)
+        data = record.get()
+
+    return {'data': data}
 
 
 @app.get("/children")
-def get_children(base: str, table: str, pkey: str):
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
-    tbl = Table(dbo, table)
-    tbl.offset = 0
-    tbl.limit = 30
-    pk = json.loads(pkey)
-    record = Record(dbo, tbl, pk)
-    return {'data': record.get_children()}
+def get_children(base: str, table: str, pkey: str,
+                 session: Session = Depends(get_session)):
+    engine = get_engine(session, base)
+    with Database.open(engine, base, session, snapshot=True) as dbo:
+        tbl = Table(dbo, table)
+        tbl.offset = 0
+        tbl.limit = 30
+        pk = json.loads(pkey)
+        record = Record(dbo, tbl, pk)
+        data = record.get_children()
+
+    return {'data': data}
 
 
 @app.get("/relations")
 def get_relations(base: str, table: str, pkey: str, count: bool,
-                  alias: str = None):
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
-    tbl = Table(dbo, table)
-    pk = json.loads(pkey)
-    record = Record(dbo, tbl, pk)
-    if count:
-        return {'data': record.get_relation_count()}
-    else:
-        relation = record.get_relation(alias)
-        return {'data': {alias: relation}}
+                  alias: str = None, session: Session = Depends(get_session)):
+    engine = get_engine(session, base)
+    with Database.open(engine, base, session, snapshot=True) as dbo:
+        tbl = Table(dbo, table)
+        pk = json.loads(pkey)
+        record = Record(dbo, tbl, pk)
+        if count:
+            return {'data': record.get_relation_count()}
+        else:
+            relation = record.get_relation(alias)
+            return {'data': {alias: relation}}
 
 
 @app.put("/table")
-async def save_table(request: Request):
+async def save_table(request: Request,
+                     session: Session = Depends(get_session)):
     req = await request.json()
     base = req['base_name']
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
-    tbl = Table(dbo, req['table_name'])
-    return {'data': tbl.save(req['records'])}
+    result = await executors.run(session, base, save_records, req, session)
+
+    return {'data': result}
+
+
+def save_records(req, session):
+    """Save records sent to PUT /table"""
+    base = req['base_name']
+    engine = get_engine(session, base)
+    with Database.open(engine, base, session) as dbo:
+        tbl = Table(dbo, req['table_name'])
+        return tbl.save(req['records'])
 
 
 @app.get("/options")
-async def get_options(request: Request):
+async def get_options(request: Request,
+                      session: Session = Depends(get_session)):
     req = Dict({item[0]: item[1]
                 for item in request.query_params.multi_items()})
-    engine = get_engine(cfg, req.base)
-    dbo = Database(engine, req.base, cfg.uid)
-    tbl = Table(dbo, req.table)
-    fld = Field(tbl, req.column)
-    conds = req.condition.split(" and ") if req.condition else []
-    search = None if 'q' not in req else req.q.replace("*", "%")
-    fkey = tbl.get_fkey(req.column)
-    if search:
-        search = search.lower()
-        view = None if not fkey else fld.get_view(fkey)
-        view = view if view else req.column
-        conds.append(f"lower(cast({view} as char)) like '%{search}%'")
-    cond = " and ".join(conds)
-    # Get condition defining classification relations
-    params = {}
-    if fkey:
-        cond2, params = fld.get_condition()
-        if cond2:
-            cond = cond + ' and ' + cond2
-
-    data = fld.get_options(cond, params)
-    return data
+
+    return await executors.run(session, req.base, read_options, req, session)
+
+
+def read_options(req, session):
+    """Return options requested in /options
+
+    If `limit` is given, returns a page of options matching `q`, with
+    labels starting with it first, and the cursor for the next page.
+    """
+    engine = get_engine(session, req.base)
+    with Database.open(engine, req.base, session) as dbo:
+        tbl = Table(dbo, req.table)
+        fld = Field(tbl, req.column)
+        conds = req.condition.split(" and ") if req.condition else []
+        search = None if 'q' not in req else req.q.replace("*", "%").lower()
+        fkey = tbl.get_fkey(req.column)
+        # Get condition defining classification relations
+        params = {}
+        if fkey:
+            cond2, params = fld.get_condition()
+            if cond2:
+                conds.append(cond2)
+
+        if req.limit:
+            cursor = None if not req.cursor else json.loads(req.cursor)
+            return fld.get_typeahead(search or '', " and ".join(conds), params,
+                                     min(int(req.limit), 200), cursor)
+
+        # Search in replica of lookup table when there are no conditions
+        lookup = None if conds else fld.get_lookup()
+        if lookup:
+            pattern = re.compile('.*'.join(
+                re.escape(part) for part in (search or '').split('%')))
+            options = [opt for opt in lookup['options']
+                       if pattern.search(str(opt['label']).lower())]
+            return options if len(options) <= 200 else False
+
+        if search:
+            view = None if not fkey else fld.get_view(fkey)
+            view = view if view else req.column
+            conds.append(f"lower(cast({view} as char)) like :search")
+            params = {**params, 'search': '%' + search + '%'}
+        cond = " and ".join(conds)
+
+        # Options for a search are not shared
+        return fld.get_options(cond, params, shared=not search)
 
 
 @app.get('/urd/dialog_cache', response_class=HTMLResponse)
@@ -500,23 +693,116 @@ def dialog_cache(request: Request):
 
 
 @app.put('/urd/update_cache')
-async def update_cache(base: str, config: str):
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+async def update_cache(base: str, config: str, incremental: bool = False,
+                       session: Session = Depends(get_session)):
+    await executors.run(session, base, build_cache, base, config,
+                        incremental, session)
+
+    return {'sucess': True, 'msg': "Cache oppdatert"}
+
+
+def require_admin(dbo):
+    """Deny access unless user is admin of the schema
+
+    Required for building the data-cache and search indexes, which
+    write to html_attributes and create tables.
+    """
+    if not dbo.user.is_admin(dbo.schema):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="No access"
+        )
+
+
+def build_cache(base, config, incremental, session):
+    """Build data-cache for database"""
+    engine = get_engine(session, base)
+    # Reflect database anew
+    metadata.store.invalidate(engine)
+    dbo = Database(engine, base, session)
+    require_admin(dbo)
+    # Data may have been changed by other applications
+    dbo.invalidate_results()
     dbo.config = Dict(json.loads(config))
     dbo.config.update_cache = True
-    dbo.get_tables()
+    dbo.get_tables(incremental)
     dbo.get_contents()
+    metadata.store.invalidate(engine)
 
-    return {'sucess': True, 'msg': "Cache oppdatert"}
+
+@app.get('/urd/search_index')
+def search_index(base: str, table: str,
+                 session: Session = Depends(get_session)):
+    """Return state of search index for table"""
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
+    index = SearchIndex(Table(dbo, table))
+
+    return {'data': index.get_info()}
+
+
+@app.put('/urd/search_index')
+async def update_search_index(base: str, table: str,
+                              session: Session = Depends(get_session)):
+    """Build search index for table, or refill it if it exists"""
+    info = await executors.run(session, base, build_search_index, base,
+                               table, session)
+
+    return {'success': True, 'data': info}
+
+
+def build_search_index(base, table, session):
+    """Build search index and return its state"""
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
+    require_admin(dbo)
+    index = SearchIndex(Table(dbo, table))
+    index.build()
+
+    return index.get_info()
+
+
+@app.delete('/urd/search_index')
+def drop_search_index(base: str, table: str,
+                      session: Session = Depends(get_session)):
+    """Remove search index for table"""
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
+    require_admin(dbo)
+    SearchIndex(Table(dbo, table)).drop()
+
+    return {'success': True}
+
+
+@app.get('/urd/metadata_cache')
+def metadata_cache():
+    """Return statistics for metadata shared between requests"""
+    return {'data': metadata.store.stats()}
+
+
+@app.get('/urd/result_cache')
+def result_cache():
+    """Return statistics for cached counts, sums, grid pages and lookups"""
+    return {'data': {**results.store.stats(), 'pages': results.pages.stats(),
+                     'lookups': lookups.store.stats()}}
+
+
+@app.delete('/urd/metadata_cache')
+def clear_metadata_cache(base: str = None,
+                         session: Session = Depends(get_session)):
+    """Remove shared metadata for database, or for all databases"""
+    engine = None if not base else get_engine(session, base)
+    metadata.store.invalidate(engine)
+
+    return {'success': True}
 
 
 @app.get('/table_sql')
 def export_sql(base: str, dialect: str, include_recs: bool, select_recs: bool,
-               table: str = None):
+               table: str = None, session: Session = Depends(get_session)):
     # Fiks alle slike connections
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
     if table:
         table = Table(dbo, table)
         ddl = table.export_ddl(dialect)
@@ -534,9 +820,10 @@ def export_sql(base: str, dialect: str, include_recs: bool, select_recs: bool,
 
 
 @app.get('/table_csv')
-def export_csv(base: str, table: str, fields: str):
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+def export_csv(base: str, table: str, fields: str,
+               session: Session = Depends(get_session)):
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
     table = Table(dbo, table)
     table.offset = 0
     table.limit = None
@@ -550,9 +837,10 @@ def export_csv(base: str, table: str, fields: str):
 
 
 @app.get('/kdrs_xml')
-def export_kdrs_xml(base: str, version: str, descr: str):
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+def export_kdrs_xml(base: str, version: str, descr: str,
+                    session: Session = Depends(get_session)):
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
     xml = dbo.export_as_kdrs_xml(version, descr)
     response = StreamingResponse(io.StringIO(xml), media_type="application/xml")
     response.headers['Content-Disposition'] = \
@@ -562,24 +850,25 @@ def export_kdrs_xml(base: str, version: str, descr: str):
 
 
 @app.get('/file')
-def get_file(base: str, table: str, pkey: str):
+def get_file(base: str, table: str, pkey: str,
+             session: Session = Depends(get_session)):
     pkey = json.loads(urllib.parse.unquote(pkey))
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
     tbl = Table(dbo, table)
     rec = Record(dbo, tbl, pkey)
     path = rec.get_file_path()
-    path = os.path.join(cfg.host, path)
+    path = os.path.join(session.host, path)
 
     return FileResponse(path)
 
 
 @app.post('/convert')
 def convert(base: str, table: str, from_format: str, to_format: str,
-            fields: str):
+            fields: str, session: Session = Depends(get_session)):
     fields = json.loads(fields)
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
     tbl = Table(dbo, table)
     for field_name in fields:
         result = tbl.convert(field_name, from_format, to_format)
@@ -588,10 +877,11 @@ def convert(base: str, table: str, from_format: str, to_format: str,
 
 
 @app.get('/query')
-def query(base: str, sql: str, limit: str):
+def query(base: str, sql: str, limit: str,
+          session: Session = Depends(get_session)):
     print('sql', sql)
-    engine = get_engine(cfg, base)
-    dbo = Database(engine, base, cfg.uid)
+    engine = get_engine(session, base)
+    dbo = Database(engine, base, session)
     limit = 0 if not limit else int(limit)
     result = dbo.query_result(sql, limit)
 
@@ -0,0 +1,116 @@
+"""Module for sharing reflected metadata between requests"""
+import time
+import threading
+from sqlalchemy import inspect
+from settings import Settings
+
+
+class MetadataStore:
+    """Process wide store of metadata, keyed by engine url and schema
+
+    Each entry holds an inspector, which caches everything reflected
+    through it, and metadata derived from the reflection, like
+    primary keys, foreign keys, table types, joins and fields.
+    Entries are renewed when the fingerprint of the schema changes,
+    and expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl=10 * 60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.renewals = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, engine, schema):
+        """Return entry for schema, and create it if missing or expired"""
+        key = (engine.url.render_as_string(hide_password=True), schema)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry.age() > self.ttl:
+                entry = Entry(self, engine)
+                self._entries[key] = entry
+
+        return entry
+
+    def renew(self, engine, schema):
+        """Replace entry for schema with an empty entry"""
+        key = (engine.url.render_as_string(hide_password=True), schema)
+        with self._lock:
+            entry = Entry(self, engine)
+            self._entries[key] = entry
+            self.renewals += 1
+
+        return entry
+
+    def invalidate(self, engine=None, schema=None):
+        """Remove entries for engine and schema, or all entries"""
+        url = (None if engine is None
+               else engine.url.render_as_string(hide_password=True))
+        with self._lock:
+            for key in list(self._entries):
+                if url not in (None, key[0]) or schema not in (None, key[1]):
+                    continue
+                del self._entries[key]
+
+    def stats(self):
+        """Return number of hits and misses, and size of entries"""
+        with self._lock:
+            entries = [{
+                'url': key[0],
+                'schema': key[1],
+                'age': round(entry.age()),
+                'items': len(entry.items)
+            } for key, entry in self._entries.items()]
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'renewals': self.renewals,
+            'ttl': self.ttl,
+            'entries': entries
+        }
+
+
+class Entry:
+    """Metadata for one schema"""
+
+    def __init__(self, store, engine):
+        self.store = store
+        self.refl = inspect(engine)
+        self.created = time.time()
+        self.fingerprint = None
+        self.items = {}
+
+    def age(self):
+        return time.time() - self.created
+
+    def check(self, fingerprint):
+        """Return False if fingerprint differs from when entry was made"""
+        if self.fingerprint is None:
+            self.fingerprint = fingerprint
+            return True
+
+        return fingerprint == self.fingerprint
+
+    def fetch(self, name, build):
+        """Return item with name, built by calling `build` if missing"""
+        if name in self.items:
+            self.store.hits += 1
+            return self.items[name]
+
+        self.store.misses += 1
+        value = build()
+        self.items[name] = value
+
+        return value
+
+    def discard(self, kind):
+        """Remove derived items of a kind, e.g. 'fields'"""
+        for name in list(self.items):
+            if name == kind or (type(name) is tuple and name[0] == kind):
+                self.items.pop(name, None)
+
+
+store = MetadataStore(Settings().metadata_ttl)
@@ -4,7 +4,7 @@ from field import Field
 from addict import Dict
 from datetime import datetime
 from sqlalchemy import text
-from column import Column
+from search import SearchIndex
 
 
 class Record:
@@ -63,82 +63,99 @@ class Record:
         })
 
     def get_relation_count(self):
+        """Return relations of record with number of related records
+
+        All relations are counted in one statement, with one count per
+        relation joined by UNION ALL. The counts aren't cached, as the
+        related tables may be in other schemas.
+
+        Nullable foreign key columns after the first one are matched
+        with IS NULL, to count records inherited from a record with
+        null in these columns. As before, this applies both to the
+        count of records and the count of inherited records.
+        """
         from database import Database
-        from table import Table, Grid
+        from table import Table
 
         values = None if len(self.pk) == 0 else self.get_values()
 
         relations = {}
+        dbs = {self.db.schema: self.db}
+        counts = []  # select counting records for each relation
+        params = {}
         for key, rel in self.tbl.relations.items():
+            if rel.table not in self.db.tablenames:
+                continue
+
             if self.db.engine.name == 'postgresql':
                 base_name = rel.schema
             else:
                 base_name = rel.base or rel.schema
 
-            if rel.schema == self.db.schema:
-                db = self.db
-            else:
-                db = Database(self.db.engine, base_name, self.db.user.name)
+            # Reuse database object for schema, with its metadata
+            if rel.schema not in dbs:
+                dbs[rel.schema] = Database(self.db.engine, base_name,
+                                           self.db.session, self.db.cnxn)
+            db = dbs[rel.schema]
 
             tbl_rel = Table(db, rel.table)
-            columns = db.refl.get_columns(rel.table, db.schema)
-            tbl_rel.cols = {col['name']: Dict(col) for col in columns}
-
-            if rel.table not in self.db.tablenames:
-                continue
 
             # Find index used
             rel.index = self.get_relation_idx(tbl_rel, rel)
             if not rel.index:
                 continue
 
-            grid = Grid(tbl_rel)
-            grid2 = Grid(tbl_rel)  # Used to count inherited records
-
-            # todo: filtrate on highest level
-
             # Add condition to fetch only rows that link to record
             conds = Dict()
+            exprs = []
             count_null_conds = 0
             show_if = None
+            prefix = f'relation_{len(relations)}_'
 
             for i, colname in enumerate(rel.constrained_columns):
                 val = None if len(self.pk) == 0 else values[rel.referred_columns[i]]
-                col = Column(self.tbl, tbl_rel.cols[colname])
+                field = tbl_rel.fields[colname]
 
-                mark = tbl_rel.view + '_' + colname
-                expr = f'{tbl_rel.view}.{colname} = :{mark}'
+                mark = prefix + colname
                 if (
-                    col.nullable and
+                    field.nullable and
                     colname != rel.constrained_columns[0] and
                     rel.referred_columns == list(self.pk.keys()) and
                     rel.index.unique is True
                 ):
-                    expr = f'{tbl_rel.view}.{colname} IS NULL'
-                    grid2.cond.prep_stmnts.append(expr)
+                    exprs.append(f'{tbl_rel.view}.{colname} IS NULL')
                     count_null_conds += 1
                 else:
-                    grid2.cond.prep_stmnts.append(expr)
-                    grid2.cond.params[mark] = val
+                    exprs.append(f'{tbl_rel.view}.{colname} = :{mark}')
+                    params[mark] = val
 
-                grid.cond.prep_stmnts.append(expr)
-                grid.cond.params[mark] = val
                 conds[colname] = val
 
-                if (colname[0] == '_' or colname[0:6] == 'const_') and col.default:
-                    show_if = {rel.referred_columns[i]: col.default}
-
-            count_records = grid.get_rowcount() if len(self.pk) else 0
-
-            count_inherited = 0
+                if colname[0] == '_' or colname[0:6] == 'const_':
+                    # Default as reflected, not as prepared for field
+                    col = [col for col in db.refl.get_columns(rel.table,
+                                                              db.schema)
+                           if col['name'] == colname][0]
+                    if col['default']:
+                        show_if = {rel.referred_columns[i]: col['default']}
+
+            idx = len(relations)
+            cond = ' and '.join(exprs)
+            # Joins are kept, as the inner join to the grid view filters
+            source = (f"from {db.schema}.{tbl_rel.view}\n"
+                      f"{tbl_rel.get_joins(cond)}where {cond}")
+            if len(self.pk):
+                counts.append(f"select {idx} as relation, 0 as inherited, "
+                              f"count(*) as n {source}")
             if count_null_conds:
-                count_inherited = grid2.get_rowcount()
+                counts.append(f"select {idx} as relation, 1 as inherited, "
+                              f"count(*) as n {source}")
 
             relation = Dict({
-                'count_records': count_records + count_inherited,
-                'count_inherited': count_inherited,
+                'count_records': 0,
+                'count_inherited': 0,
                 'name': rel.table,
-                'conditions': grid.get_client_conditions(),
+                'conditions': [],
                 'conds': conds,
                 'base_name': rel.base,
                 'schema_name': rel.schema,
@@ -150,6 +167,25 @@ class Record:
 
             relations[key] = relation
 
+        if not counts:
+            return relations
+
+        sql = '\nunion all\n'.join(counts)
+
+        with self.db.connect() as cnxn:
+            rows = cnxn.execute(text(sql), params).all()
+
+        keys = list(relations.keys())
+        for idx, inherited, n in rows:
+            relation = relations[keys[idx]]
+            if inherited:
+                relation.count_inherited = n
+            else:
+                relation.count_records = n
+
+        for relation in relations.values():
+            relation.count_records += relation.count_inherited
+
         return relations
 
     def get_relation_idx(self, tbl_rel, rel):
@@ -171,7 +207,8 @@ class Record:
             base_name = rel.base + '.' + rel.schema
         else:
             base_name = rel.base or rel.schema
-        db = Database(self.db.engine, base_name, self.db.user.name)
+        db = Database(self.db.engine, base_name, self.db.session,
+                      self.db.cnxn)
         tbl_rel = Table(db, rel.table)
         grid = Grid(tbl_rel)
         tbl_rel.limit = 500  # TODO: should have pagination in stead
@@ -244,7 +281,7 @@ class Record:
         where {cond}
         """
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             row = cnxn.execute(text(sql), params).mappings().fetchone()
         self.cache.vals = row
 
@@ -252,9 +289,17 @@ class Record:
 
     def get_display_values(self):
         displays = {}
+        labels = {}
 
         for key, field in self.tbl.fields.items():
-            if 'view' in field:
+            if 'view' not in field:
+                continue
+            # Labels from replica of lookup table instead of join
+            lookup = Field(self.tbl, key).get_lookup()
+            if lookup:
+                labels[key] = lookup['labels']
+                displays[key] = f"{self.tbl.view}.{key} as {key}"
+            else:
                 displays[key] = f"({field.view}) as {key}"
 
         if len(displays) == 0:
@@ -267,12 +312,17 @@ class Record:
 
         sql = "select " + select + "\n"
         sql += f"from {self.db.schema}.{self.tbl.view}\n"
-        sql += self.tbl.joins + "\n"
+        sql += self.tbl.get_joins(select, cond) + "\n"
         sql += " where " + cond
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             row = cnxn.execute(text(sql), self.pk).mappings().fetchone()
 
+        if row and labels:
+            row = dict(row)
+            for key, col_labels in labels.items():
+                row[key] = col_labels.get(row[key], row[key])
+
         return row
 
     def get_children(self):
@@ -312,7 +362,7 @@ class Record:
         where {cond}
         """
 
-        with self.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             row = cnxn.execute(text(sql), self.pk).first()
 
         return os.path.normpath(row.path)
@@ -322,7 +372,7 @@ class Record:
 
         # Get autoinc values for primary keys
         # Supports simple and compound primary keys
-        for colname in self.tbl.pkey.colnames:
+        for colname in self.tbl.pkey.columns:
             if colname in values:
                 self.pk[colname] = values[colname]
         inc_col = self.tbl.pkey.columns[-1]
@@ -343,7 +393,7 @@ class Record:
             sql += f"else max({inc_col}) +1 end from {self.tbl.name} "
             sql += "" if not len(cols) else "where " + " and ".join(conditions)
 
-            with self.db.engine.connect() as cnxn:
+            with self.db.connect() as cnxn:
                 values[inc_col] = cnxn.execute(text(sql), params).first()[0]
             self.pk[inc_col] = values[inc_col]
 
@@ -368,9 +418,11 @@ class Record:
         values ({', '.join([f":{key}" for key in inserts])})
         """
 
-        with self.db.engine.connect() as conn:
+        with self.db.connect() as conn:
             conn.execute(text(sql), inserts)
             conn.commit()
+        self.db.invalidate_results([self.tbl.name, self.tbl.view])
+        SearchIndex(self.tbl).refresh_record(None, self.pk)
 
         return self.pk
 
@@ -384,6 +436,7 @@ class Record:
                         rel_rec.values[colname] = self.pk[pk_col]
 
     def update(self, values):
+        old_pkey = dict(self.pk)
         set_values = {}
         # todo: get values for auto update fields
         for field in self.tbl.fields.values():
@@ -414,14 +467,16 @@ class Record:
         where {where_str}
         """
 
-        with self.db.engine.connect() as conn:
+        with self.db.connect() as conn:
             result = conn.execute(text(sql), params)
             conn.commit()
+        self.db.invalidate_results([self.tbl.name, self.tbl.view])
 
         # Update primary key
         for key, value in values.items():
             if key in self.pk:
                 self.pk[key] = value
+        SearchIndex(self.tbl).refresh_record(old_pkey, self.pk)
 
         return result
 
@@ -440,8 +495,10 @@ class Record:
         where {where_str}
         """
 
-        with self.db.engine.connect() as conn:
+        with self.db.connect() as conn:
             result = conn.execute(text(sql), self.pk)
             conn.commit()
+        self.db.invalidate_results([self.tbl.name, self.tbl.view])
+        SearchIndex(self.tbl).refresh_record(self.pk, None)
 
         return result
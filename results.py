@@ -0,0 +1,204 @@
+"""Module for caching results of queries and responses"""
+import time
+import threading
+from collections import OrderedDict
+from settings import Settings
+
+
+class TaggedCache:
+    """Base for caches with entries tagged by the tables they depend on
+
+    Each invalidation gets a new generation number, stored for the
+    tables it applies to. An entry built while its tables were
+    invalidated is not stored, as it may hold data from before the
+    write.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        # Last generation invalidating table, or all tables of schema
+        self._invalidated = {}
+
+    def generation(self):
+        """Return current generation, to be read before building entry"""
+        with self._lock:
+            return self._generation
+
+    def _is_current(self, key, tables, generation):
+        """Return True if tables are not invalidated since generation
+
+        Must be called holding the lock.
+        """
+        url, schema = key[0], key[1]
+        names = [None] + list(tables)
+
+        return all(self._invalidated.get((url, schema, name), 0) <= generation
+                   for name in names)
+
+    def _set_invalidated(self, url, schema, tables):
+        """Register invalidation of tables, must be called holding lock"""
+        self._generation += 1
+        for name in [None] if tables is None else tables:
+            self._invalidated[(url, schema, name)] = self._generation
+
+
+class ResultCache(TaggedCache):
+    """Process wide cache of query results, like counts and sums
+
+    Results are keyed by engine url, schema, kind and the sql and params
+    of the query, and tagged with the tables read by the query. Writes
+    to a table remove the results tagged with it. Holds at most `size`
+    results, removing the least recently used, and results expire after
+    `ttl` seconds, as data can be changed by other applications.
+    """
+
+    def __init__(self, size=1000, ttl=5 * 60):
+        super().__init__()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key, tables, build):
+        """Return result for key, built by calling `build` if missing
+
+        Parameters:
+        key: Tuple of engine url, schema, kind, sql and params
+        tables: Names of tables the result depends on
+        build: Function returning the result
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry and time.time() - entry['created'] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry['value']
+            self.misses += 1
+            generation = self._generation
+
+        value = build()
+        with self._lock:
+            if not self._is_current(key, tables, generation):
+                return value
+            self._entries[key] = {
+                'value': value,
+                'tables': set(tables),
+                'created': time.time()
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, url, schema, tables=None):
+        """Remove results for schema depending on tables, or all results"""
+        with self._lock:
+            self._set_invalidated(url, schema, tables)
+            for key in list(self._entries):
+                if key[0] != url or key[1] != schema:
+                    continue
+                if tables is None or self._entries[key]['tables'] & tables:
+                    del self._entries[key]
+
+    def stats(self):
+        """Return number of hits and misses, and number of results"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'ttl': self.ttl
+            }
+
+
+class PageCache(TaggedCache):
+    """Process wide cache of serialized grid page responses
+
+    Responses are keyed by engine url, schema, and the normalized
+    request, and tagged with the tables they are read from. Holds at
+    most `size` bytes of responses, removing the least recently used,
+    and responses expire after `ttl` seconds.
+
+    Writes only remove responses in the process handling them, so the
+    cache is turned off when the server runs in several processes.
+    """
+
+    def __init__(self, size=50 * 1024 * 1024, ttl=60):
+        super().__init__()
+        self.size = size
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return response for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry and time.time() - entry['created'] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry['body']
+            self.misses += 1
+
+        return None
+
+    def put(self, key, body, tables, generation):
+        """Store response, unless it would take up most of the cache
+
+        Parameters:
+        key: Tuple starting with engine url and schema
+        body: Serialized response
+        tables: Names of tables the response is read from
+        generation: Generation read before the response was made
+        """
+        if len(body) > self.size / 4:
+            return
+        with self._lock:
+            if not self._is_current(key, tables, generation):
+                return
+            self._remove(key)
+            self._entries[key] = {
+                'body': body,
+                'tables': set(tables),
+                'created': time.time()
+            }
+            self.bytes += len(body)
+            while self.bytes > self.size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= len(entry['body'])
+
+    def invalidate(self, url, schema, tables=None):
+        """Remove responses for schema reading tables, or all responses"""
+        with self._lock:
+            self._set_invalidated(url, schema, tables)
+            for key in list(self._entries):
+                if key[0] != url or key[1] != schema:
+                    continue
+                if tables is None or self._entries[key]['tables'] & tables:
+                    self._remove(key)
+
+    def stats(self):
+        """Return number of hits and misses, and size of responses"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'responses': len(self._entries),
+                'bytes': self.bytes,
+                'size': self.size,
+                'ttl': self.ttl
+            }
+
+
+cfg = Settings()
+store = ResultCache(cfg.result_cache_size, cfg.result_cache_ttl)
+pages = PageCache(cfg.page_cache_size if cfg.processes == 1 else 0,
+                  cfg.page_cache_ttl)
@@ -0,0 +1,479 @@
+"""Module for full-text search indexes of tables"""
+import re
+import time
+import bisect
+import threading
+import simplejson as json
+from addict import Dict
+from sqlalchemy import text
+from settings import Settings
+
+cfg = Settings()
+# In-memory indexes for databases without native full-text search,
+# keyed by engine url, schema and table
+memory_indexes = {}
+memory_lock = threading.Lock()
+
+
+class SearchIndex:
+    """Full-text index of the text in the records of a table
+
+    The text columns of each record, and the labels of its foreign
+    keys, are collected in a document stored with the primary key of
+    the record in the table `_search_<table>`. SQLite uses an FTS5
+    table, PostgreSQL a tsvector column with a GIN index and MySQL a
+    FULLTEXT index. Other databases get an inverted index held in
+    memory, which must be built again after restart.
+
+    Terms match words starting with the term, and not any part of a
+    word like the LIKE conditions used when there is no index.
+    """
+
+    def __init__(self, tbl):
+        self.tbl = tbl
+        self.db = tbl.db
+        self.name = '_search_' + tbl.name
+        if self.db.engine.name == 'sqlite':
+            self.kind = 'fts5'
+        elif self.db.engine.name == 'postgresql':
+            self.kind = 'tsvector'
+        elif self.db.engine.name in ['mysql', 'mariadb']:
+            self.kind = 'fulltext'
+        else:
+            self.kind = 'memory'
+
+    @property
+    def key(self):
+        """Key of in-memory index"""
+        url = self.db.engine.url.render_as_string(hide_password=True)
+        return (url, self.db.schema, self.tbl.name)
+
+    def exists(self):
+        """Return True if index is built"""
+        if self.kind == 'memory':
+            return self.key in memory_indexes
+
+        return self.name in self.db.search_tables
+
+    def is_current(self):
+        """Return True if index is built and not marked as stale"""
+        info = self.db.search_info.get(self.tbl.name, None) or {}
+
+        return self.exists() and not info.get('stale', False)
+
+    def get_cond(self, value):
+        """Return condition for records matching all terms in value
+
+        Condition is None if the index can't be used for the value.
+        """
+        terms = re.findall(r'\w+', value.lower())
+        pkey = self.tbl.pkey.columns
+        if not terms or not pkey or pkey == ['rowid']:
+            return None, {}
+
+        cols = ', '.join(f'{self.tbl.view}.{col}' for col in pkey)
+        if len(pkey) > 1:
+            cols = '(' + cols + ')'
+
+        if self.kind == 'memory':
+            return self.get_memory_cond(terms, cols)
+
+        if self.kind == 'fts5':
+            query = ' '.join(f'"{term}"*' for term in terms)
+            match = f"{self.name} match :search_terms"
+        elif self.kind == 'tsvector':
+            query = ' & '.join(f'{term}:*' for term in terms)
+            match = "document @@ to_tsquery('simple', :search_terms)"
+        else:
+            # Terms not indexed by MySQL would match nothing
+            min_size, stopwords = self.get_fulltext_limits()
+            if any(len(term) < min_size or term in stopwords
+                   for term in terms):
+                return None, {}
+            query = ' '.join(f'+{term}*' for term in terms)
+            match = "match(document) against (:search_terms in boolean mode)"
+
+        expr = f"""{cols} in (
+            select {', '.join(pkey)} from {self.db.schema}.{self.name}
+            where {match})"""
+
+        return expr, {'search_terms': query}
+
+    def get_fulltext_limits(self):
+        """Return min length of words in FULLTEXT index, and stopwords"""
+        def build():
+            with self.db.connect() as cnxn:
+                min_size, table = cnxn.execute(text("""
+                select @@innodb_ft_min_token_size,
+                       @@innodb_ft_server_stopword_table
+                """)).first()
+                if table:
+                    table = '.'.join(f'`{part}`' for part in table.split('/'))
+                    sql = f"select value from {table}"
+                else:
+                    sql = """
+                    select value
+                    from information_schema.innodb_ft_default_stopword
+                    """
+                stopwords = cnxn.execute(text(sql)).scalars().all()
+
+            return int(min_size), set(word.lower() for word in stopwords)
+
+        return self.db.metadata.fetch('fulltext_limits', build)
+
+    def get_memory_cond(self, terms, cols):
+        """Return condition with keys of records found in memory index
+
+        Condition is None if more records are found than can be used as
+        parameters, or if the index is dropped meanwhile.
+        """
+        found = None
+        with memory_lock:
+            index = memory_indexes.get(self.key, None)
+            if index is None:
+                return None, {}
+            for term in terms:
+                keys = set()
+                pos = bisect.bisect_left(index.words, term)
+                while (
+                    pos < len(index.words) and
+                    index.words[pos].startswith(term)
+                ):
+                    keys.update(index.postings[index.words[pos]])
+                    pos += 1
+                found = keys if found is None else found & keys
+
+        if len(found) > cfg.search_memory_limit:
+            return None, {}
+        if not found:
+            return '1 = 0', {}
+
+        params = {}
+        marks = []
+        for idx, key in enumerate(found):
+            names = []
+            for n, value in enumerate(key):
+                params[f'search_{idx}_{n}'] = value
+                names.append(f':search_{idx}_{n}')
+            marks.append(names[0] if len(key) == 1
+                         else '(' + ', '.join(names) + ')')
+
+        return f"{cols} in ({', '.join(marks)})", params
+
+    def get_documents(self, cond=None, params=None):
+        """Return primary key and document of records
+
+        Parameters:
+        cond: Condition for the records to get documents for
+        params: Parameters of the condition
+        """
+        pkey = self.tbl.pkey.columns
+        exprs = []
+        for field in self.tbl.fields.values():
+            if field.fkey and field.view:
+                exprs.append(field.view)
+            elif field.datatype == 'str':
+                exprs.append(f'{self.tbl.view}.{field.name}')
+
+        selects = [f'{self.tbl.view}.{col}' for col in pkey] + exprs
+        sql = f"select {', '.join(selects)}\n"
+        sql += f"from {self.db.schema}.{self.tbl.view}\n"
+        sql += self.tbl.get_joins(*exprs, cond or '')
+        if cond:
+            sql += "where " + cond
+
+        with self.db.connect() as cnxn:
+            rows = cnxn.execute(text(sql), params or {}).fetchall()
+
+        return [(tuple(row[:len(pkey)]),
+                 ' '.join(str(val) for val in row[len(pkey):]
+                          if val is not None))
+                for row in rows]
+
+    def create(self, cnxn):
+        """Create table holding index"""
+        pkey = self.tbl.pkey.columns
+        schema = self.db.schema
+        if self.kind == 'fts5':
+            cnxn.execute(text(f"""
+            create virtual table {schema}.{self.name}
+            using fts5(document, {', '.join(f'{col} unindexed'
+                                            for col in pkey)})
+            """))
+            return
+
+        dialect = self.db.engine.dialect
+        types = {col['name']: col['type'].compile(dialect=dialect)
+                 for col in self.db.refl.get_columns(self.tbl.name, schema)}
+        cols = [f"{col} {types[col]} not null" for col in pkey]
+        if self.kind == 'tsvector':
+            cnxn.execute(text(f"""
+            create table {schema}.{self.name} (
+                {', '.join(cols)},
+                document tsvector,
+                primary key ({', '.join(pkey)})
+            )
+            """))
+            cnxn.execute(text(f"""
+            create index {self.name}_document_idx
+            on {schema}.{self.name} using gin (document)
+            """))
+        else:
+            cnxn.execute(text(f"""
+            create table {schema}.{self.name} (
+                {', '.join(cols)},
+                document longtext,
+                primary key ({', '.join(pkey)}),
+                fulltext index {self.name}_document_idx (document)
+            )
+            """))
+
+    def insert(self, cnxn, docs):
+        """Insert documents into index table"""
+        pkey = self.tbl.pkey.columns
+        document = ':document'
+        if self.kind == 'tsvector':
+            document = "to_tsvector('simple', :document)"
+        sql = f"""
+        insert into {self.db.schema}.{self.name}
+        ({', '.join(pkey)}, document)
+        values ({', '.join(f':{col}' for col in pkey)}, {document})
+        """
+        params = [dict(zip(pkey, key), document=doc) for key, doc in docs]
+        if not params:
+            return
+        for idx in range(0, len(params), 1000):
+            cnxn.execute(text(sql), params[idx:idx + 1000])
+
+    def build(self):
+        """Build index, or refill it if it exists"""
+        start = time.time()
+        docs = self.get_documents()
+
+        if self.kind == 'memory':
+            index = Dict({'words': [], 'postings': {}, 'docs': {}})
+            self.add_to_memory(index, docs)
+            with memory_lock:
+                memory_indexes[self.key] = index
+        else:
+            exists = self.exists()
+            with self.db.engine.connect() as cnxn:
+                if exists:
+                    cnxn.execute(text(f"delete from {self.db.schema}."
+                                      f"{self.name}"))
+                else:
+                    self.create(cnxn)
+                self.insert(cnxn, docs)
+                cnxn.commit()
+            if not exists:
+                self.db.search_tables.add(self.name)
+                # Index tables are not part of the data-cache
+                self.db.set_cache_fingerprint()
+
+        self.db.invalidate_results([self.tbl.name])
+        self.save_info({
+            'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'seconds': round(time.time() - start, 2),
+            'documents': len(docs)
+        })
+
+    def drop(self):
+        """Remove index"""
+        if self.kind == 'memory':
+            with memory_lock:
+                memory_indexes.pop(self.key, None)
+        elif self.exists():
+            with self.db.engine.connect() as cnxn:
+                cnxn.execute(text(f"drop table {self.db.schema}.{self.name}"))
+                cnxn.commit()
+            self.db.search_tables.discard(self.name)
+            self.db.set_cache_fingerprint()
+        self.save_info(None)
+
+    def refresh_record(self, old_pkey, pkey_vals):
+        """Update documents after record is inserted, updated or deleted
+
+        The documents of records referring to an updated record are
+        updated too, as they hold its label.
+
+        Parameters:
+        old_pkey: Primary key before update, or None after insert
+        pkey_vals: Current primary key of record, or None after delete
+        """
+        if self.exists():
+            pkey = self.tbl.pkey.columns
+            docs = []
+            if pkey_vals:
+                conds = [f"{self.tbl.view}.{col} = :{col}" for col in pkey]
+                docs = self.get_documents(" and ".join(conds), pkey_vals)
+            keys = [] if not old_pkey else [
+                tuple(old_pkey[col] for col in pkey)]
+            self.replace_documents(keys, docs)
+
+        if old_pkey and pkey_vals:
+            self.refresh_referring(pkey_vals)
+
+    def refresh_referring(self, pkey_vals):
+        """Update documents of indexed records referring to record
+
+        Indexes are marked as stale instead, if more than
+        `search_refresh_limit` records refer to the record, or they
+        refer to other columns than the primary key.
+        """
+        from table import Table
+        for rel in self.tbl.relations.values():
+            if (
+                rel.schema != self.db.schema or
+                rel.table not in self.db.tablenames
+            ):
+                continue
+            index = SearchIndex(Table(self.db, rel.table))
+            if not index.is_current():
+                continue
+            if not set(rel.referred_columns) <= set(pkey_vals):
+                index.mark_stale()
+                continue
+
+            conds = []
+            params = {}
+            for col, ref_col in zip(rel.constrained_columns,
+                                    rel.referred_columns):
+                conds.append(f"{index.tbl.view}.{col} = :ref_{col}")
+                params['ref_' + col] = pkey_vals[ref_col]
+            cond = " and ".join(conds)
+            sql = f"""
+            select count(*) from {self.db.schema}.{index.tbl.view}
+            where {cond}
+            """
+            with self.db.connect() as cnxn:
+                count = cnxn.execute(text(sql), params).scalar()
+            if count > cfg.search_refresh_limit:
+                index.mark_stale()
+                continue
+
+            docs = index.get_documents(cond, params)
+            index.replace_documents([key for key, doc in docs], docs)
+
+    def replace_documents(self, keys, docs):
+        """Remove documents with primary keys in keys, and add docs"""
+        pkey = self.tbl.pkey.columns
+        if self.kind == 'memory':
+            with memory_lock:
+                index = memory_indexes.get(self.key, None)
+                if index is None:
+                    return
+                for key in keys:
+                    for word in index.docs.pop(key, []):
+                        index.postings[word].discard(key)
+                self.add_to_memory(index, docs)
+            return
+        conds = " and ".join(f"{col} = :{col}" for col in pkey)
+        with self.db.connect() as cnxn:
+            for key in keys:
+                cnxn.execute(text(f"""
+                delete from {self.db.schema}.{self.name} where {conds}
+                """), dict(zip(pkey, key)))
+            self.insert(cnxn, docs)
+            cnxn.commit()
+
+    def mark_stale(self):
+        """Mark index as not to be used until it's built again"""
+        if 'html_attributes' not in self.db.tablenames:
+            self.drop()
+            return
+        info = self.db.search_info.get(self.tbl.name, None) or {}
+        self.save_info({**info, 'stale': True})
+
+    def add_to_memory(self, index, docs):
+        """Add words of documents to in-memory index"""
+        for key, doc in docs:
+            words = set(re.findall(r'\w+', doc.lower()))
+            index.docs[key] = words
+            for word in words:
+                if word not in index.postings:
+                    index.postings[word] = set()
+                    bisect.insort(index.words, word)
+                index.postings[word].add(key)
+
+    def save_info(self, info):
+        """Save when index was built in html_attributes"""
+        if 'html_attributes' not in self.db.tablenames:
+            return
+        selector = 'data-search.' + self.tbl.name
+        with self.db.engine.connect() as cnxn:
+            cnxn.execute(text(f"""
+            delete from {self.db.schema}.html_attributes
+            where selector = :selector
+            """), {'selector': selector})
+            if info:
+                cnxn.execute(text(f"""
+                insert into {self.db.schema}.html_attributes
+                (selector, attributes) values (:selector, :attrs)
+                """), {'selector': selector, 'attrs': json.dumps(info)})
+            cnxn.commit()
+        self.db.metadata.discard('search_info')
+        self.db.__dict__.pop('_search_info', None)
+
+    def get_info(self):
+        """Return state of index, and how many records it's missing"""
+        info = Dict({
+            'table': self.tbl.name,
+            'index': self.name,
+            'kind': self.kind,
+            'exists': self.exists()
+        })
+        if 'html_attributes' in self.db.tablenames:
+            sql = f"""
+            select attributes from {self.db.schema}.html_attributes
+            where selector = :selector
+            """
+            with self.db.connect() as cnxn:
+                attrs = cnxn.execute(text(sql), {
+                    'selector': 'data-search.' + self.tbl.name
+                }).scalar()
+            if attrs:
+                info.update(json.loads(attrs))
+
+        if not info.exists:
+            return info
+
+        if self.kind == 'memory':
+            with memory_lock:
+                index = memory_indexes.get(self.key, None)
+                info.documents = len(index.docs) if index else 0
+        else:
+            sql = f"select count(*) from {self.db.schema}.{self.name}"
+            with self.db.connect() as cnxn:
+                info.documents = cnxn.execute(text(sql)).scalar()
+        sql = f"select count(*) from {self.db.schema}.{self.tbl.name}"
+        with self.db.connect() as cnxn:
+            info.records = cnxn.execute(text(sql)).scalar()
+        info.missing = info.records - info.documents
+        # Stale indexes are not used until they are built again
+        info.stale = info.get('stale', False)
+
+        return info
+
+
+def mark_stale(db, tables):
+    """Mark indexes depending on tables written to outside records as stale
+
+    Indexes of the tables, and of tables referring to them, are marked.
+    All indexes are marked if tables is None.
+    """
+    from table import Table
+    url = db.engine.url.render_as_string(hide_password=True)
+    indexed = set(db.search_info)
+    indexed.update(name[len('_search_'):] for name in db.search_tables)
+    indexed.update(key[2] for key in list(memory_indexes)
+                   if key[:2] == (url, db.schema))
+    if tables is not None:
+        names = set(tables)
+        for tbl_name in tables:
+            names.update(rel.table for rel in db.relations[tbl_name].values())
+        indexed &= names
+
+    for tbl_name in indexed & set(db.tablenames):
+        index = SearchIndex(Table(db, tbl_name))
+        if index.is_current():
+            index.mark_stale()
@@ -0,0 +1,21 @@
+"""Module for the session of the logged in user"""
+from pydantic import BaseModel, ConfigDict
+
+
+class Session(BaseModel):
+    """Connection parameters of the logged in user
+
+    Made from the session cookie for each request, and passed to the
+    objects handling the request. The session is immutable, so that
+    concurrent requests can't alter each other's credentials.
+    """
+    model_config = ConfigDict(frozen=True)
+
+    system: str | None = None
+    host: str | None = None
+    database: str | None = None
+    uid: str | None = None
+    pwd: str | None = None
+    role: str | None = None
+    # Seconds before session cookie expires. None for no expiration
+    timeout: int | None = None
@@ -9,6 +9,7 @@ class Settings(BaseSettings):
     database: str | None = None
     uid: str | None = None
     pwd: str | None = None
+    role: str | None = None
     mysql_driver: str = 'mysqlconnector'
     mariadb_driver: str = 'mysqlconnector'
     postgresql_driver: str = 'psycopg2'
@@ -16,6 +17,27 @@ class Settings(BaseSettings):
     oracle_driver: str = 'cx_oracle'
     mssql_driver: str = 'pyodbc'
     norwegian_chars: bool = True
+    engine_cache_size: int = 20
+    engine_ttl: int = 30 * 60  # 30 minutes
+    metadata_ttl: int = 24 * 60 * 60  # 24 hours
+    cache_compress: bool = False
+    workers: int = 4
+    executor_size: int = 8  # threads per database system
+    database_limit: int = 4  # concurrent heavy requests per database
+    grid_split_query: bool = False  # separate queries for values and text
+    count_timeout: int = 2000  # milliseconds for exact count of grid rows
+    count_limit: int = 10000  # rows counted when exact count times out
+    result_cache_size: int = 1000  # cached counts and sums
+    result_cache_ttl: int = 5 * 60  # 5 minutes
+    page_cache_size: int = 50 * 1024 * 1024  # bytes of grid pages
+    page_cache_ttl: int = 60  # seconds
+    processes: int = 1  # server processes, page cache is off if more
+    children_count: str = 'page'  # 'page' or 'subquery'
+    search_memory_limit: int = 1000  # records found by in-memory index
+    search_refresh_limit: int = 1000  # referring documents updated on write
+    lookup_rows: int = 1000  # max rows of replicated lookup tables
+    lookup_size: int = 10 * 1024 * 1024  # bytes of lookup replicas
+    lookup_ttl: int = 10 * 60  # 10 minutes
 
     class Config:
         env_prefix = 'urdr_'
@@ -1,5 +1,7 @@
 """Module for handling tables"""
+import re
 import datetime
+from copy import deepcopy
 import pypandoc
 from addict import Dict
 from record import Record
@@ -28,7 +30,14 @@ class Table:
     def type(self):
         """Return type of table"""
         if not hasattr(self, '_type'):
-            self.init_type()
+            if (
+                (self.db.cache and not self.db.config.update_cache) or
+                hasattr(self, 'main_type')
+            ):
+                self.init_type()
+            else:
+                self._type = self.db.metadata.fetch(('type', self.name),
+                                                    self.init_type)
 
         return self._type
 
@@ -105,7 +114,7 @@ class Table:
 
     def count_rows(self):
         sql = f'select count(*) from "{self.name}"'
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             return cnxn.execute(text(sql)).first()[0]
 
     def is_hidden(self):
@@ -161,10 +170,17 @@ class Table:
     def fields(self):
         """Return all fields of table"""
         if not hasattr(self, '_fields'):
+            # Fields are copied because values are set on them
             if (self.db.cache and not self.db.config.update_cache):
-                self._fields = self.db.cache.tables[self.name].fields
-            else:
+                fields = self.db.get_cache_shard(self.name).fields
+                self._fields = deepcopy(fields)
+            elif self.db.config.update_cache:
                 self.init_fields()
+            else:
+                fields = self.db.metadata.fetch(
+                    ('fields', self.name, self.db.user.name),
+                    self.init_fields)
+                self._fields = deepcopy(fields)
 
         return self._fields
 
@@ -177,7 +193,8 @@ class Table:
             self._pkey = self.db.cache.tables[self.name].pkey
             return self._pkey
 
-        self._pkey = self.db.pkeys[self.name]
+        # Copy to not alter primary keys shared with other requests
+        self._pkey = Dict(self.db.pkeys[self.name])
 
         if (not self._pkey.columns and self.db.engine.name == 'sqlite'):
             self._pkey.columns = ['rowid']
@@ -204,10 +221,36 @@ class Table:
     @property
     def joins(self):
         """Return all joins to table as single string"""
-        if hasattr(self, '_joins'):
-            return self._joins
-        joins = []
-        aliases = []
+        return "\n".join(self.join_list.values()) + "\n"
+
+    @property
+    def join_list(self):
+        """Return joins to table by alias"""
+        if not hasattr(self, '_join_list'):
+            self._join_list = self.db.metadata.fetch(
+                ('joins', self.name, self.db.user.name), self.init_joins)
+
+        return self._join_list
+
+    def get_joins(self, *exprs):
+        """Return joins needed by the sql expressions as single string
+
+        A left join is left out if its alias isn't referenced in any of
+        the expressions. This doesn't change the rows returned, as left
+        joins to referred tables and 1:1 relations match at most one row.
+        Inner joins, like the one to the grid view, can filter rows and
+        are always kept.
+        """
+        sql = ' '.join(exprs)
+        joins = [join for alias, join in self.join_list.items()
+                 if not join.startswith('left join') or
+                 re.search(r'\b' + re.escape(alias) + r'\.', sql)]
+
+        return "\n".join(joins) + "\n"
+
+    def init_joins(self):
+        """Make Dict with joins to table by alias"""
+        joins = Dict()
 
         for key, fkey in self.fkeys.items():
             if fkey.referred_table not in self.db.tablenames:
@@ -217,19 +260,17 @@ class Table:
 
             # In seldom cases there might be two foreign keys ending
             # in same column
-            if alias in aliases:
+            if alias in joins:
                 alias = alias + '2'
 
-            aliases.append(alias)
-
             # Get the ON statement in the join
             ons = [f'{alias}.{fkey.referred_columns[idx]} = '
                    f'{self.view}.{col}'
                    for idx, col in enumerate(fkey.constrained_columns)]
             on_list = ' AND '.join(ons)
 
-            joins.append(f'left join {self.db.schema}.{fkey.referred_table} '
-                         f'{alias} on {on_list}')
+            joins[alias] = (f'left join {self.db.schema}.'
+                            f'{fkey.referred_table} {alias} on {on_list}')
 
         for key, fkey in self.relations.items():
             if fkey.relationship == '1:1':
@@ -238,22 +279,17 @@ class Table:
                        f"{self.view}.{col}"
                        for idx, col in enumerate(fkey.referred_columns)]
                 on_list = ' AND '.join(ons)
-                joins.append(f"left join {self.db.schema}.{fkey.table} "
-                             f"on {on_list}")
-
-        self._joins = "\n".join(joins)
+                joins[alias] = (f"left join {self.db.schema}.{fkey.table} "
+                                f"on {on_list}")
 
         if (self.name + '_grid') in self.db.tablenames:
             join_view = "join " + self.grid_view + " on "
             ons = [f'{self.grid_view}.{col} = {self.view}.{col}'
                    for col in self.pkey.columns]
-            join_view += ' AND '.join(ons) + "\n"
-        else:
-            join_view = ""
+            join_view += ' AND '.join(ons)
+            joins[self.grid_view] = join_view
 
-        self._joins += "\n" + join_view
-
-        return self._joins
+        return joins
 
     def get_relation(self, alias):
         """Return single relation"""
@@ -273,8 +309,9 @@ class Table:
     def get_access_code_idx(self):
         idx_name = self.name.rstrip('_') + '_access_code_idx'
 
+        # Indexes are shared, so table is set on a copy
         if idx_name in self.indexes:
-            idx = self.indexes[idx_name]
+            idx = deepcopy(self.indexes[idx_name])
             idx.table = self.view
             return idx
 
@@ -283,13 +320,13 @@ class Table:
 
             # accept index name based on main table
             if rel.relationship == '1:1' and idx_name in rel_table.indexes:
-                idx = rel_table.indexes[idx_name]
+                idx = deepcopy(rel_table.indexes[idx_name])
                 idx.table = rel.table
                 return idx
 
             idx_name_rel = rel.table.rstrip('_') + '_access_code_idx'
             if rel.relationship == '1:1' and idx_name_rel in rel_table.indexes:
-                idx = rel_table.indexes[idx_name_rel]
+                idx = deepcopy(rel_table.indexes[idx_name_rel])
                 idx.table = rel.table
                 return idx
 
@@ -354,7 +391,8 @@ class Table:
                 if rel.schema == self.db.schema:
                     rel_db = self.db
                 else:
-                    rel_db = Database(self.db.engine, rel.schema, self.db.user.name)
+                    rel_db = Database(self.db.engine, rel.schema,
+                                      self.db.session, self.db.cnxn)
 
                 rel_table = Table(rel_db, rel.table_name)
 
@@ -373,8 +411,15 @@ class Table:
 
                 rel_table.save(rel.records)
 
+        self.invalidate_metadata()
+
         return result
 
+    def invalidate_metadata(self):
+        """Remove metadata depending on the records in this table"""
+        if self.name == 'html_attributes':
+            self.db.metadata.discard('html_attrs')
+
     def init_fkeys(self):
         """Store foreign keys in table object"""
         if (self.db.cache and not self.db.config.update_cache):
@@ -395,13 +440,13 @@ class Table:
         # contents = None if not self.db.cache \
         #     else self.db.cache.contents
 
-        for col in cols:
-            col = Dict(col)
-
+        def build(col):
             column = Column(self, col)
             field = Field(self, col.name)
             field.set_attrs_from_col(column)
-            if hasattr(field, 'fkey'):
+            # Options are only stored with fields in the data-cache, as
+            # they depend on records of other tables
+            if hasattr(field, 'fkey') and self.db.config.update_cache:
                 condition, params = field.get_condition()
                 field.options = field.get_options(condition, params)
 
@@ -430,7 +475,14 @@ class Table:
                 if col.type_name not in ['blob', 'clob', 'text']:
                     field.frequency = column.check_frequency()
 
-            fields[col.name] = field.get()
+            return field.get()
+
+        # Fields are analysed in parallel when building the data-cache
+        self.pkey
+        self.fkeys
+        cols = [Dict(col) for col in cols]
+        for col, field in zip(cols, self.db.map(build, cols)):
+            fields[col.name] = field
 
         updated_idx = self.indexes.get(self.name + "_updated_idx", None)
         if updated_idx:
@@ -451,6 +503,8 @@ class Table:
 
         self._fields = fields
 
+        return fields
+
     def init_indexes(self):
         """Store Dict of indexes as attribute of table object"""
         if self.db.cache and not self.db.config.update_cache:
@@ -486,14 +540,16 @@ class Table:
                         table.pkey.columns == self.pkey.columns
                     ):
                         table_name = table.name
+        # Relations are copied because values are set on them
         if hasattr(self.db, 'relations') and not self.db.config.update_cache:
-            self._relations = self.db.relations[table_name]
+            self._relations = deepcopy(self.db.relations[table_name])
             return
         if self.db.cache and not self.db.config.update_cache:
-            self._relations = self.db.cache.tables[table_name].relations
+            self._relations = deepcopy(
+                self.db.cache.tables[table_name].relations)
             return
 
-        relations = self.db.relations[table_name]
+        relations = deepcopy(self.db.relations[table_name])
 
         # find how much the relation is used
         if self.db.config.column_use:
@@ -504,7 +560,7 @@ class Table:
                 select count(distinct({fkey_col})) from {relation.table}
                 """
 
-                with self.db.engine.connect() as cnxn:
+                with self.db.connect() as cnxn:
                     count = cnxn.execute(text(sql)).first()[0]
 
                 relations[name].use = count/self.rowcount if self.rowcount > 0 else 0
@@ -594,7 +650,7 @@ class Table:
         else:
             sql = f"select * from {self.name}"
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             rows = cnxn.execute(text(sql)).mappings()
 
         if select_recs:
@@ -630,7 +686,7 @@ class Table:
         from {self.name}
         """
 
-        with self.db.engine.connect() as cnxn:
+        with self.db.connect() as cnxn:
             rows = cnxn.execute(text(sql)).mappings()
         for row in rows:
             if row[colname] is None:
@@ -658,7 +714,7 @@ class Table:
             where {where}
             """
 
-            with self.db.engine.connect() as conn:
+            with self.db.connect() as conn:
                 conn.execute(text(sql), params)
                 conn.commit()
 
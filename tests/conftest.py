@@ -0,0 +1,88 @@
+import os
+import sys
+import sqlite3
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# main.py reads the static files relative to working directory
+os.chdir(ROOT)
+
+from fastapi.testclient import TestClient  # noqa: E402
+import main  # noqa: E402
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Return directory with SQLite database test.db"""
+    cnxn = sqlite3.connect(tmp_path / 'test.db')
+    cnxn.executescript("""
+    create table place (
+        code varchar(5) primary key,
+        name varchar(50) not null
+    );
+    create unique index place_name_idx on place(name);
+    create table person (
+        id integer primary key,
+        name varchar(100) not null,
+        place varchar(5) references place(code),
+        amount numeric(10, 2)
+    );
+    create index person_grid_idx on person(name, place, amount);
+    create table person_note (
+        person integer references person(id),
+        no integer,
+        note varchar(100),
+        primary key (person, no)
+    );
+    """)
+    cnxn.executemany("insert into place values (?, ?)", [
+        ('osl', 'Oslo'), ('brg', 'Bergen'), ('trd', 'Trondheim')
+    ])
+    cnxn.executemany("insert into person values (?, ?, ?, ?)", [
+        (i, f'Person {i}', ['osl', 'brg', 'trd'][i % 3], i * 1.5)
+        for i in range(1, 101)
+    ])
+    cnxn.executemany("insert into person_note values (?, ?, ?)", [
+        (1, 1, 'First note'), (1, 2, 'Second note'), (2, 1, 'Note')
+    ])
+    cnxn.commit()
+    cnxn.close()
+
+    return str(tmp_path)
+
+
+def login(server, username):
+    """Return client logged in to test.db as user"""
+    client = TestClient(main.app)
+    response = client.post('/login', params={
+        'system': 'sqlite',
+        'server': server,
+        'username': username,
+        'password': '',
+        'database': 'test.db'
+    })
+    assert response.status_code == 200
+
+    return client
+
+
+@pytest.fixture
+def client(server):
+    """Return client logged in to test.db"""
+    return login(server, 'test')
+
+
+@pytest.fixture
+def statements():
+    """Return list of statements executed while test runs"""
+    executed = []
+
+    def count(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', count)
+    yield executed
+    event.remove(Engine, 'before_cursor_execute', count)
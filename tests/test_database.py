@@ -0,0 +1,34 @@
+from database import Database
+
+
+def is_catalog_query(statement):
+    return statement.startswith('PRAGMA') or 'sqlite_master' in statement
+
+
+def test_statements(client, statements, monkeypatch):
+    comment_reads = []
+    init_comments = Database.init_comments
+
+    def count_comment_reads(self):
+        comment_reads.append(self.schema)
+
+        return init_comments(self)
+
+    monkeypatch.setattr(Database, 'init_comments', count_comment_reads)
+
+    # Cold snapshot reflects the schema, and reads comments once
+    response = client.get('/database', params={'base': 'test.db'})
+    assert response.status_code == 200
+    assert len(comment_reads) == 1
+    catalog_queries = [stmt for stmt in statements if is_catalog_query(stmt)]
+    assert len(catalog_queries) == 30
+
+    # Warm snapshot only checks the fingerprint of the schema, and the
+    # tables available for the user
+    statements.clear()
+    response = client.get('/database', params={'base': 'test.db'})
+    assert response.status_code == 200
+    assert len(comment_reads) == 1
+    catalog_queries = [stmt for stmt in statements if is_catalog_query(stmt)]
+    assert len(catalog_queries) == 1
+    assert len(statements) == 2
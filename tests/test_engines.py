@@ -0,0 +1,18 @@
+import pytest
+from sqlalchemy import exc
+from engines import EngineRegistry
+
+
+def test_discard_engine_failing_to_connect(tmp_path, monkeypatch):
+    registry = EngineRegistry()
+    key = ('sqlite', str(tmp_path), 'missing/test.db', 'test', None)
+    url = f'sqlite:///{tmp_path}/missing/test.db'
+    engine, created = registry.get(key, url)
+    disposed = []
+    monkeypatch.setattr(engine, 'dispose', lambda: disposed.append(engine))
+
+    with pytest.raises(exc.OperationalError):
+        engine.connect()
+
+    assert disposed == [engine]
+    assert registry.get(key, url)[0] is not engine
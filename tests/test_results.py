@@ -0,0 +1,33 @@
+from results import ResultCache, PageCache
+
+
+def test_result_written_during_build():
+    cache = ResultCache()
+    key = ('url', 'main', 'count', 'select count(*) from person', '{}')
+    builds = []
+
+    def build():
+        builds.append(1)
+        # Table written to while result is read
+        cache.invalidate('url', 'main', {'person'})
+        return 100
+
+    assert cache.fetch(key, ['person'], build) == 100
+    assert cache.fetch(key, ['person'], lambda: 101) == 101
+    assert cache.fetch(key, ['person'], lambda: 102) == 101
+
+
+def test_page_written_during_build():
+    cache = PageCache()
+    key = ('url', 'main', 'page')
+
+    generation = cache.generation()
+    cache.invalidate('url', 'main', {'place'})
+    cache.put(key, b'page', {'person', 'place'}, generation)
+    assert cache.get(key) is None
+
+    # Writes to other tables don't matter
+    generation = cache.generation()
+    cache.invalidate('url', 'main', {'node'})
+    cache.put(key, b'page', {'person', 'place'}, generation)
+    assert cache.get(key) == b'page'
@@ -0,0 +1,222 @@
+import os
+import json
+import sqlite3
+import grid
+from user import User
+from conftest import login
+
+
+def get_table(client, table='person', **params):
+    response = client.get('/table', params={
+        'base': 'test.db', 'table': table, 'limit': 10, **params
+    })
+    assert response.status_code == 200
+
+    return response.json()['data']
+
+
+def save_record(client, table, method, prim_key, values):
+    response = client.put('/table', json={
+        'base_name': 'test.db',
+        'table_name': table,
+        'records': [{
+            'method': method,
+            'prim_key': prim_key,
+            'values': values,
+            'relations': {}
+        }]
+    })
+    assert response.status_code == 200
+
+
+def test_statements(client, statements):
+    get_table(client)
+
+    # Metadata is cached, so a new page needs only the check that the
+    # schema is unchanged, and the query for the page
+    statements.clear()
+    data = get_table(client, offset=10)
+    assert len(data['records']) == 10
+    assert len(statements) == 2
+
+    # Pages are cached too
+    statements.clear()
+    get_table(client, offset=10)
+    assert len(statements) == 1
+
+
+def test_grid_view(server, client):
+    cnxn = sqlite3.connect(os.path.join(server, 'test.db'))
+    cnxn.execute("""
+    create view person_grid as
+    select id, name, place from person where id <= 40
+    """)
+    cnxn.commit()
+    cnxn.close()
+
+    data = get_table(client)
+    assert data['count_records'] == 40
+    assert len(data['records']) == 10
+
+
+def test_options_after_write(client):
+    def get_options():
+        response = client.get('/options', params={
+            'base': 'test.db', 'table': 'person', 'column': 'place'
+        })
+        assert response.status_code == 200
+
+        return response.json()
+
+    assert len(get_options()) == 3
+    save_record(client, 'place', 'post', {},
+                {'code': 'krs', 'name': 'Kristiansand'})
+    assert len(get_options()) == 4
+
+
+def test_search_index(client):
+    def count(value):
+        return get_table(client, filter=value)['count_records']
+
+    # State of index is saved in html_attributes, made with the cache
+    response = client.put('/urd/update_cache', params={
+        'base': 'test.db', 'config': json.dumps({})
+    })
+    assert response.status_code == 200
+    response = client.put('/urd/search_index', params={
+        'base': 'test.db', 'table': 'person'
+    })
+    assert response.status_code == 200
+    assert count('oslo') == 33
+
+    # Documents of referring records hold the label of the place
+    save_record(client, 'place', 'put', {'code': 'osl'},
+                {'name': 'Kristiania'})
+    assert count('oslo') == 0
+    assert count('kristiania') == 33
+
+    # Writes outside of records make the index stale, and not used
+    response = client.get('/query', params={
+        'base': 'test.db',
+        'sql': "update place set name = 'Oslo' where code = 'osl'",
+        'limit': 10
+    })
+    assert response.status_code == 200
+    response = client.get('/urd/search_index', params={
+        'base': 'test.db', 'table': 'person'
+    })
+    assert response.json()['data']['stale']
+    assert count('oslo') == 33
+
+
+def test_relation_count(server, client):
+    def count_notes():
+        response = client.get('/relations', params={
+            'base': 'test.db',
+            'table': 'person',
+            'pkey': json.dumps({'id': 1}),
+            'count': True
+        })
+        assert response.status_code == 200
+
+        relation = response.json()['data']['person_note_person_fkey']
+
+        return relation['count_records']
+
+    assert count_notes() == 2
+    save_record(client, 'person_note', 'post', {},
+                {'person': 1, 'no': 3, 'note': 'Third note'})
+    assert count_notes() == 3
+
+    # Records not in the grid view are not counted
+    cnxn = sqlite3.connect(os.path.join(server, 'test.db'))
+    cnxn.execute("""
+    create view person_note_grid as
+    select person, no, note from person_note where no < 3
+    """)
+    cnxn.commit()
+    cnxn.close()
+    assert count_notes() == 2
+
+
+def test_children_count(server, client):
+    cnxn = sqlite3.connect(os.path.join(server, 'test.db'))
+    cnxn.executescript("""
+    create table category (
+        id integer primary key,
+        code varchar(10) not null unique,
+        name varchar(50),
+        parent varchar(10) references category(code)
+    );
+    insert into category values (1, 'a', 'A', null);
+    insert into category values (2, 'b', 'B', 'a');
+    insert into category values (3, 'c', 'C', 'a');
+    create view category_grid as select id, name from category;
+    """)
+    cnxn.commit()
+    cnxn.close()
+
+    # Referred column is not among the values of the grid
+    data = get_table(client, table='category')
+    counts = {rec['pkey']['id']: rec['count_children']
+              for rec in data['records']}
+    assert counts == {1: 2}
+
+
+def test_relations_by_user(server, monkeypatch):
+    tables = User.tables
+
+    def user_tables(self, schema):
+        names = tables(self, schema)
+        if self.name == 'limited':
+            names.remove('person_note')
+
+        return names
+
+    monkeypatch.setattr(User, 'tables', user_tables)
+
+    def form_items(username):
+        client = login(server, username)
+        data = get_table(client)
+
+        return data['form']['items'].values()
+
+    # Relations hidden for one user are shown for others
+    relation = 'relation.person_note_person_fkey'
+    assert relation not in form_items('limited')
+    assert relation in form_items('full')
+    assert relation not in form_items('limited')
+
+
+def test_rowcount_estimate(server, client, monkeypatch):
+    monkeypatch.setattr(grid.cfg, 'count_limit', 10)
+    cnxn = sqlite3.connect(os.path.join(server, 'test.db'))
+    cnxn.execute("analyze")
+    cnxn.commit()
+
+    data = get_table(client)
+    assert data['count_method'] == 'estimate'
+    assert data['count_records'] == 100
+
+    # Estimate for table is not used when grid view filters rows
+    cnxn.execute("""
+    create view person_grid as
+    select id, name, place from person where id <= 5
+    """)
+    cnxn.commit()
+    cnxn.close()
+    data = get_table(client)
+    assert data['count_method'] == 'exact'
+    assert data['count_records'] == 5
+
+
+def test_metadata_version(client):
+    version = get_table(client)['metadata_version']
+
+    # Version is the same after the shared metadata is renewed, as in
+    # another process
+    response = client.delete('/urd/metadata_cache')
+    assert response.status_code == 200
+    data = get_table(client, metadata_version=version)
+    assert data['metadata_version'] == version
+    assert 'form' not in data
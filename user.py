@@ -1,14 +1,14 @@
 import re
 from addict import Dict
 from sqlalchemy import text, inspect
-from settings import Settings
 
 
 class User:
 
-    def __init__(self, engine, name=None):
+    def __init__(self, engine, name=None, session=None):
         self.name = name or engine.url.username
         self.engine = engine
+        self.session = session
         self.current = name is None
         self._is_admin = {}
 
@@ -82,12 +82,15 @@ class User:
         return rows
 
     def tables(self, schema):
-        cfg = Settings()
         refl = inspect(self.engine)
         tbl_names = refl.get_table_names(schema)
-        if self.engine.name == 'sqlite' and cfg.database == 'urdr.db':
+        if (
+            self.engine.name == 'sqlite' and
+            self.session.database == 'urdr.db'
+        ):
             db_path = self.engine.url.database
-            db_name = self.engine.url.database.split(cfg.host)[1].lstrip('/')
+            host = self.session.host
+            db_name = self.engine.url.database.split(host)[1].lstrip('/')
             urdr = 'main' if db_path.endswith('/urdr.db') else 'urdr'
             sql = f"""
             with recursive cte_access (code, parent) as (
@@ -182,11 +185,13 @@ class User:
         privilege['update'] = 0
         privilege.delete = 0
 
-        cfg = Settings()
-
-        if self.engine.name == 'sqlite' and cfg.database == 'urdr.db':
+        if (
+            self.engine.name == 'sqlite' and
+            self.session.database == 'urdr.db'
+        ):
             db_path = self.engine.url.database
-            db_name = self.engine.url.database.split(cfg.host)[1].lstrip('/')
+            host = self.session.host
+            db_name = self.engine.url.database.split(host)[1].lstrip('/')
             urdr = 'main' if db_path.endswith('/urdr.db') else 'urdr'
 
             sql = f"""
@@ -247,7 +252,6 @@ class User:
     def table_privilege(self, schema, table):
         """Return privileges of database user"""
 
-        cfg = Settings()
         schema_privilege = self.schema_privilege(schema)
 
         privilege = Dict({
@@ -256,9 +260,13 @@ class User:
             'update': schema_privilege['update'] or 0,
             'delete': schema_privilege.delete or 0
         })
-        if self.engine.name == 'sqlite' and cfg.database == 'urdr.db':
+        if (
+            self.engine.name == 'sqlite' and
+            self.session.database == 'urdr.db'
+        ):
             db_path = self.engine.url.database
-            db_name = self.engine.url.database.split(cfg.host)[1].lstrip('/')
+            host = self.session.host
+            db_name = self.engine.url.database.split(host)[1].lstrip('/')
             urdr = 'main' if db_path.endswith('/urdr.db') else 'urdr'
             sql = f"""
             select count(*) from {urdr}.table_access ta
@@ -374,8 +382,10 @@ class User:
             return self._is_admin[schema]
         self._is_admin[schema] = False
 
-        cfg = Settings()
-        if self.engine.name == 'sqlite' and cfg.database == 'urdr.db':
+        if (
+            self.engine.name == 'sqlite' and
+            self.session.database == 'urdr.db'
+        ):
             return 'sysadmin' in self.access_codes
         elif self.engine.name in ['mysql', 'mariadb']:
             with self.engine.connect() as cnxn: